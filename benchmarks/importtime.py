@@ -0,0 +1,52 @@
+"""Import-time regression benchmark for the pdftowrite and writetopdf entry points.
+
+Usage: python benchmarks/importtime.py [--runs N] [--max-ms MS]
+"""
+import argparse, os, re, statistics, subprocess, sys
+
+MODULES = { 'pdftowrite': 'pdftowrite.pdftowrite', 'writetopdf': 'pdftowrite.writetopdf' }
+# Heavy optional dependencies that must only be imported by the code paths that need them
+LAZY_MODULES = ['picosvg', 'pathops', 'shortuuid', 'urllib.request', 'http.client', 'http.server', 'pdftowrite.remote',
+                'ctypes', 'pdftowrite.watch', 'pdftowrite.pdfopt']
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def importtime(module: str) -> tuple[int,dict[str,int]]:
+    res = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                         cwd=ROOT, capture_output=True, text=True, check=True)
+    cumulative = {}
+    for line in res.stderr.splitlines():
+        match = re.match(r'import time:\s*(\d+)\s*\|\s*(\d+)\s*\|\s*(.+)$', line)
+        if not match: continue
+        cumulative[match.group(3).strip()] = int(match.group(2))
+    return cumulative[module], cumulative
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure import time of the entry points')
+    parser.add_argument('--runs', type=int, default=10, help='Number of runs (default: 10)')
+    parser.add_argument('--max-ms', type=float, default=None,
+                        help='Fail if the median import time of an entry point exceeds this')
+    parser.add_argument('--top', type=int, default=10, help='Number of slowest imports to show (default: 10)')
+    ns = parser.parse_args()
+
+    failed = False
+    for name, module in MODULES.items():
+        times = []
+        for _ in range(ns.runs):
+            total, cumulative = importtime(module)
+            times.append(total)
+        median_ms = statistics.median(times) / 1000
+        print(f'{name}: {median_ms:.1f} ms (median of {ns.runs})')
+        slowest = sorted(cumulative.items(), key=lambda kv: -kv[1])[:ns.top]
+        for mod, us in slowest:
+            print(f'  {us / 1000:8.1f} ms  {mod}')
+        eager = [mod for mod in cumulative if any(mod == m or mod.startswith(m + '.') for m in LAZY_MODULES)]
+        if eager:
+            print(f'  error: imported at startup: {", ".join(eager)}')
+            failed = True
+        if ns.max_ms is not None and median_ms > ns.max_ms:
+            print(f'  error: exceeds {ns.max_ms} ms')
+            failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,8 @@
 import xml.etree.ElementTree as ET
-import re, copy, subprocess, tempfile
-import shortuuid
+import re, copy, tempfile
 from typing import Optional
 import pdftowrite.utils as utils
-from picosvg.svg import SVG
+import pdftowrite.svgopt as svgopt
 from subprocess import DEVNULL
 from pathlib import Path
 from abc import ABC, abstractmethod
@@ -64,12 +63,34 @@ class SizeBox(ABC):
             self.size_element.set('viewBox', value)
 
 class Background(SizeBox):
-    def __init__(self, page_num, svg, text_layer_svg, compat_mode=True, uniquify=True):
+    def __init__(self, page_num, svg, text_layer_svg, compat_mode=True, uniquify=True,
+                 optimize=False, precision=0.0001, image_dpi=None, image_quality=85, limits=None):
+        import shortuuid
         self.page_num = page_num
         self.suffix = '-' + shortuuid.uuid()[:7] + '-p' + str(self.page_num)
-        self.__process_svg(svg, text_layer_svg, compat_mode, uniquify)
+        self.pdf_hash = None
+        self.optimize_stats = None
+        self.text_layer_stats = None
+        self.image_stats = None
+        self.__limits = limits # Limits of the external commands, the process-wide ones if None
+        self.__process_svg(svg, text_layer_svg, compat_mode, uniquify, optimize, precision, image_dpi, image_quality)
         self.tree.getroot().set('class', self.tree.getroot().get('class', '') + ' page-background')
 
+    @classmethod
+    def load(cls, page_num, svg) -> 'Background':
+        # Creates a Background from the svg of an already processed one
+        self = cls.__new__(cls)
+        self.page_num = page_num
+        self.tree = ET.ElementTree( ET.fromstring(svg) )
+        self.suffix = ''
+        self.pdf_hash = None
+        self.optimize_stats = None
+        self.text_layer_stats = None
+        self.image_stats = None
+        layers = utils.find_elements_by_class(self.tree, 'pdftowrite-text-layer')
+        self.text_layer = layers[0] if layers else None
+        return self
+
     @property
     def size_element(self) -> ET.Element:
         return self.tree.getroot()
@@ -78,7 +99,8 @@ class Background(SizeBox):
     def svg(self) -> str:
         return ET.tostring(self.tree.getroot(), encoding='unicode')
 
-    def __process_svg(self, svg, text_layer_svg, compat_mode, uniquify) -> None:
+    def __process_svg(self, svg, text_layer_svg, compat_mode, uniquify, optimize, precision,
+                      image_dpi, image_quality) -> None:
         svg = re.sub(r'<\?xml[^(\?>)]*\?>', '', svg)
         self.tree = ET.ElementTree( ET.fromstring(svg) )
         self.__remove_metadata()
@@ -87,9 +109,11 @@ class Background(SizeBox):
             self.__simplify()
             self.__remove_masked_rects()
             self.__convert_masked_images()
+        if image_dpi: self.image_stats = svgopt.optimize_images(self.tree, image_dpi, image_quality, limits=self.__limits)
+        if optimize: self.__optimize(precision)
         if uniquify: self.__uniquify()
         if text_layer_svg:
-            self.text_layer = self.__create_text_layer(text_layer_svg)
+            self.text_layer = self.__create_text_layer(text_layer_svg, optimize)
             self.tree.getroot().append(self.text_layer)
         else:
             self.text_layer = None
@@ -109,8 +133,15 @@ class Background(SizeBox):
                 style = re.sub(r'[^;]*inkscape[^;]*(;|$)', '', style)
                 el.set('style', style)
 
+    def __optimize(self, precision):
+        size = len(self.svg)
+        svgopt.minify(self.tree, precision)
+        self.optimize_stats = (size, len(self.svg))
+
     def __simplify(self):
         try:
+            # picosvg (and skia-pathops) is only needed here, so it is not imported at startup
+            from picosvg.svg import SVG
             self.__tree_map = { el.get('id', ''): el for el in self.tree.iter() }
             self.__parent_map = { c:p for p in self.tree.iter() for c in p }
 
@@ -249,8 +280,8 @@ class Background(SizeBox):
                 with open(mask_path, 'wb') as f:
                     f.write(mask_data)
                     f.flush()
-                subprocess.check_call(
-                    ['convert', img_path, mask_path, '-compose', 'CopyOpacity', '-composite', comb_path],
+                utils.check_call(
+                    ['convert', img_path, mask_path, '-compose', 'CopyOpacity', '-composite', comb_path], self.__limits,
                     stdout=DEVNULL, stderr=DEVNULL)
                 with open(comb_path, 'rb') as f:
                     data = f.read()
@@ -280,7 +311,7 @@ class Background(SizeBox):
             newv = re.sub(r'url\s*\(\s*#\s*(.+?)\s*\)', lambda m: f'url(#{m.group(1) + suffix})', v)
             el.set(k, newv)
 
-    def __create_text_layer(self, text_layer_svg) -> ET.Element:
+    def __create_text_layer(self, text_layer_svg, compact) -> ET.Element:
         tree = ET.ElementTree( ET.fromstring(text_layer_svg) )
         text_layer_vb = tree.getroot().get('viewBox')
         text_layer_vb_width = utils.viewbox_vals(text_layer_vb)[2]
@@ -289,6 +320,7 @@ class Background(SizeBox):
         self.__parent_map = { c:p for p in tree.iter() for c in p }
         group = self.__create_text_group(tree)
         self.__parent_map = None
+        style = self.__compact_text_group(group) if compact else None
 
         el = ET.Element('svg')
         el.set('id', 'text-layer' + self.suffix)
@@ -296,9 +328,20 @@ class Background(SizeBox):
         el.set('width', utils.viewbox_vals(self.viewbox)[2])
         el.set('height', utils.viewbox_vals(self.viewbox)[3])
         el.set('viewBox', f'0 0 {text_layer_vb_width} {text_layer_vb_height}')
+        if style is not None: el.append(style)
         el.append(group)
         return el
 
+    def __compact_text_group(self, group: ET.Element) -> Optional[ET.Element]:
+        size = len(ET.tostring(group, encoding='unicode'))
+        count = sum(1 for _ in group.iter())
+        style = svgopt.compact_text(group, self.suffix)
+        new_size = len(ET.tostring(group, encoding='unicode'))
+        if style is not None: new_size += len(ET.tostring(style, encoding='unicode'))
+        new_count = sum(1 for _ in group.iter())
+        self.text_layer_stats = (size, new_size, count, new_count)
+        return style
+
     def __create_text_group(self, tree) -> ET.Element:
         group = ET.Element('g')
         g = tree.getroot().find('./{%s}g[last()]' % SVG_NS)
@@ -382,6 +425,15 @@ class Page(SizeBox):
         else:
             return None
 
+    @property
+    def pdf_hash(self) -> Optional[str]:
+        return self.ruleline.get('data-pdf-hash', None)
+
+    @property
+    def annotations(self) -> list[ET.Element]:
+        ruleline = self.ruleline
+        return [el for el in self.write_content if el is not ruleline]
+
     def __process_svg(self, svg) -> None:
         svg = re.sub(r'<\?xml[^(\?>)]*\?>', '', svg)
         self.tree = ET.ElementTree( ET.fromstring(svg) )
@@ -402,7 +454,8 @@ class Page(SizeBox):
             return self.element
 
 class Document:
-    def __init__(self, svg: str, page_nums: set[int]):
+    def __init__(self, svg: str, page_nums: set[int], offset: int = 0):
+        # offset numbers the pages after those of preceding volumes
         self.tree = ET.ElementTree( ET.fromstring(svg) )
         self.pages = []
         page_els = self.tree.getroot().findall('./{%s}svg' % SVG_NS)
@@ -410,9 +463,9 @@ class Document:
         for page_el in page_els:
             num += 1
             if 'write-page' not in page_el.get('class', ''): continue
-            if num not in page_nums: continue
+            if offset + num not in page_nums: continue
             page_svg = ET.tostring(page_el, encoding='unicode')
-            page = Page(num, page_svg)
+            page = Page(offset + num, page_svg)
             self.pages.append(page)
         if num <= 0: raise Exception('Document has no pages')
 
@@ -0,0 +1,300 @@
+import os, re, hashlib, zlib
+from typing import Optional
+
+OBJ_HEADER = re.compile(rb'(\d+)\s+(\d+)\s+obj(?![^\s\[\]<>(){}/%])')
+# Strings, comments and the keywords that end the dictionary part of an object
+TOKEN = re.compile(rb'<<|\(|<|%|(?<![^\s\[\]<>(){}/%])(stream|endobj)(?![^\s\[\]<>(){}/%])')
+REF = re.compile(rb'(?<![^\s\[\]<>(){}])(\d+)\s+(\d+)\s+R(?![^\s\[\]<>(){}/%])')
+DIRECT_LENGTH = re.compile(rb'/Length\s+(\d+)(?!\d|\s+\d+\s+R)')
+EOL = re.compile(rb'[\r\n]')
+TYPE = re.compile(rb'/Type\s*/(\w+)')
+TRAILER = re.compile(rb'trailer\s*(<<.*?>>)\s*startxref', re.S)
+# Cross-reference streams, object streams and encryption are not supported
+UNSUPPORTED = re.compile(rb'/Type\s*/(?:XRef|ObjStm)(?![^\s\[\]<>(){}/%])|/Encrypt(?![^\s\[\]<>(){}/%])')
+# Objects whose identity matters even if their content is the same
+KEEP_TYPES = { b'Catalog', b'Pages', b'Page', b'Annot' }
+ROOT = re.compile(rb'/Root\s+(\d+)\s+(\d+)\s+R')
+PAGES = re.compile(rb'/Pages\s+(\d+)\s+(\d+)\s+R')
+KIDS = re.compile(rb'/Kids\s*\[([^\]]*)\]')
+PARENT = re.compile(rb'/Parent\s+\d+\s+\d+\s+R')
+COUNT = re.compile(rb'/Count\s+\d+')
+OBJ_STREAM = re.compile(rb'/Type\s*/ObjStm(?![^\s\[\]<>(){}/%])')
+FLATE_ONLY = re.compile(rb'/Filter\s*(?:/FlateDecode|\[\s*/FlateDecode\s*\])(?![^\s\[\]<>(){}/%])')
+FIRST = re.compile(rb'/First\s+(\d+)')
+CONTENTS = re.compile(rb'/Contents\s*(\[[^\]]*\]|\d+\s+\d+\s+R)')
+FORM = re.compile(rb'/Subtype\s*/Form(?![^\s\[\]<>(){}/%])')
+PAGE_NODE = re.compile(rb'/Type\s*/Pages?(?![^\s\[\]<>(){}/%])')
+
+class PdfObject:
+    def __init__(self, head: bytes, stream: bytes):
+        self.head = head # The dictionary part, without "N G obj"
+        self.stream = stream # From "stream" up to "endobj", if any
+        self.digest = hashlib.sha256(stream).digest() if stream else b''
+        match = TYPE.search(head)
+        self.fixed = match is not None and match.group(1) in KEEP_TYPES
+
+def _skip_literal(data: bytes, i: int) -> int:
+    depth = 0
+    while i < len(data):
+        c = data[i]
+        if c == 0x5c: # Backslash
+            i += 2
+            continue
+        if c == 0x28:
+            depth += 1
+        elif c == 0x29:
+            depth -= 1
+            if depth == 0: return i + 1
+        i += 1
+    return len(data)
+
+def _skip_token(data: bytes, match: re.Match) -> int:
+    token = match.group(0)
+    if token == b'(':
+        return _skip_literal(data, match.start())
+    if token == b'<':
+        end = data.find(b'>', match.end())
+        return end + 1 if end >= 0 else len(data)
+    if token == b'%':
+        eol = EOL.search(data, match.end())
+        return eol.start() if eol else len(data)
+    return match.end()
+
+def _scan_object(data: bytes, pos: int) -> tuple[int,int,int]:
+    # Returns the end of the dictionary part, the start of "endobj" and the end of the object
+    while True:
+        match = TOKEN.search(data, pos)
+        if not match: raise ValueError('Missing endobj')
+        if match.group(1) == b'endobj':
+            return match.start(), match.start(), match.end()
+        if match.group(1) == b'stream':
+            head_end = match.start()
+            start = match.end()
+            if data[start:start+2] == b'\r\n': start += 2
+            elif data[start:start+1] in (b'\n', b'\r'): start += 1
+            length = DIRECT_LENGTH.search(data, pos, head_end)
+            end = -1
+            if length:
+                end = int(length.group(1)) + start
+                if not data[end:end+20].lstrip().startswith(b'endstream'): end = -1
+            if end < 0:
+                end = data.find(b'endstream', start)
+                if end < 0: raise ValueError('Missing endstream')
+            endobj = data.find(b'endobj', end)
+            if endobj < 0: raise ValueError('Missing endobj')
+            return head_end, endobj, endobj + len(b'endobj')
+        pos = _skip_token(data, match)
+
+def parse_objects(data: bytes) -> tuple[bytes,dict[tuple[int,int],PdfObject]]:
+    # Scans the file body rather than the cross-reference table, so later definitions
+    # from incremental updates replace earlier ones
+    objects = {}
+    header = None
+    pos = 0
+    while True:
+        match = OBJ_HEADER.search(data, pos)
+        if not match: break
+        if header is None: header = data[:match.start()]
+        head_end, endobj, pos = _scan_object(data, match.end())
+        ref = (int(match.group(1)), int(match.group(2)))
+        objects[ref] = PdfObject(data[match.end():head_end], data[head_end:endobj])
+    return header or b'', objects
+
+def replace_refs(text: bytes, replace) -> bytes:
+    # Replaces "N G R" references with replace(ref), leaving strings and comments as they are
+    result = []
+    pos = 0
+    sub = lambda m: replace((int(m.group(1)), int(m.group(2))))
+    while pos < len(text):
+        match = TOKEN.search(text, pos)
+        code_end = match.start() if match else len(text)
+        result.append( REF.sub(sub, text[pos:code_end]) )
+        if not match: break
+        end = _skip_token(text, match)
+        result.append( text[code_end:end] )
+        pos = end
+    return b''.join(result)
+
+def rewrite_refs(text: bytes, resolve) -> bytes:
+    return replace_refs(text, lambda ref: b'%d %d R' % resolve(ref))
+
+def find_refs(text: bytes) -> list[tuple[int,int]]:
+    result = []
+    replace_refs(text, lambda ref: result.append(ref) or b'')
+    return result
+
+def stream_data(obj: PdfObject) -> bytes:
+    # The raw data between "stream" and "endstream"
+    start = len(b'stream')
+    if obj.stream[start:start+2] == b'\r\n': start += 2
+    elif obj.stream[start:start+1] in (b'\n', b'\r'): start += 1
+    return obj.stream[start:obj.stream.rfind(b'endstream')]
+
+def expand_object_streams(objects: dict[tuple[int,int],PdfObject]) -> None:
+    # Adds the objects stored in compressed object streams, which the file body scan cannot see
+    for obj in list(objects.values()):
+        if not obj.stream or not OBJ_STREAM.search(obj.head): continue
+        first = FIRST.search(obj.head)
+        if not first or not FLATE_ONLY.search(obj.head) or b'/DecodeParms' in obj.head: continue
+        try:
+            data = zlib.decompress(stream_data(obj))
+        except zlib.error:
+            continue
+        first = int(first.group(1))
+        numbers = [int(n) for n in data[:first].split()]
+        offsets = [(numbers[i], first + numbers[i+1]) for i in range(0, len(numbers) - 1, 2)]
+        for i, (num, start) in enumerate(offsets):
+            end = offsets[i+1][1] if i + 1 < len(offsets) else len(data)
+            objects.setdefault((num, 0), PdfObject(data[start:end], b''))
+
+def page_tree(data: bytes, objects: dict[tuple[int,int],PdfObject]) -> list[tuple[tuple[int,int],list[tuple[int,int]]]]:
+    # Returns the pages in order, each with its ancestors in the page tree
+    roots = ROOT.findall(data)
+    if not roots: return []
+    catalog = objects.get((int(roots[-1][0]), int(roots[-1][1])))
+    pages = PAGES.search(catalog.head) if catalog else None
+    if not pages: return []
+    result = []
+    stack = [((int(pages.group(1)), int(pages.group(2))), [])]
+    visited = set()
+    while stack:
+        ref, ancestors = stack.pop()
+        if ref in visited or ref not in objects: continue
+        visited.add(ref)
+        kids = KIDS.search(objects[ref].head)
+        if kids:
+            stack.extend((kid, [*ancestors, ref]) for kid in reversed(find_refs(kids.group(1))))
+        else:
+            result.append((ref, ancestors))
+    return result
+
+def load_objects(data: bytes) -> dict[tuple[int,int],PdfObject]:
+    _, objects = parse_objects(data)
+    expand_object_streams(objects)
+    return objects
+
+def page_digest(data: bytes) -> str:
+    # Hashes the first page and everything it refers to, with each reference replaced by the
+    # hash of its object (a Merkle hash), so the digest does not depend on object numbers
+    objects = load_objects(data)
+    pages = page_tree(data, objects)
+    if not pages: raise ValueError('No pages found')
+    page, ancestors = pages[0]
+    hashes = {}
+    visiting = set()
+
+    def digest(ref) -> bytes:
+        if ref in hashes: return hashes[ref]
+        # References back to an object being hashed (e.g. the /P of an annotation) and
+        # to missing objects are hashed as null
+        if ref in visiting or ref not in objects: return b'null'
+        obj = objects[ref]
+        # Other pages (e.g. the destination of a link) are not part of the page
+        if ref != page and PAGE_NODE.search(obj.head): return b'page'
+        visiting.add(ref)
+        head = replace_refs(PARENT.sub(b'', obj.head), lambda r: b'<' + digest(r).hex().encode() + b'>')
+        hashes[ref] = hashlib.sha256(b' '.join(head.split()) + b'\0' + obj.digest).digest()
+        visiting.discard(ref)
+        return hashes[ref]
+
+    h = hashlib.sha256(digest(page))
+    # Attributes like /Resources and /MediaBox can be inherited from the page tree
+    for ref in ancestors:
+        head = COUNT.sub(b'', KIDS.sub(b'', PARENT.sub(b'', objects[ref].head)))
+        h.update( replace_refs(b' '.join(head.split()), lambda r: b'<' + digest(r).hex().encode() + b'>') )
+    return h.hexdigest()
+
+def page_content_sizes(data: bytes) -> dict[int,int]:
+    # Returns the bytes of the content streams and forms drawn by each page, from one scan
+    # of the file. Images are left out, because their pixels are counted separately.
+    objects = load_objects(data)
+    result = {}
+    for num, (page, ancestors) in enumerate(page_tree(data, objects), 1):
+        contents = CONTENTS.search(objects[page].head)
+        size = sum(len(objects[ref].stream) for ref in find_refs(contents.group(1)) if ref in objects) if contents else 0
+        # Forms are found through the resources and annotations, and resources can be inherited
+        heads = [objects[page].head, *(KIDS.sub(b'', objects[ref].head) for ref in ancestors)]
+        stack = [ref for head in heads for ref in find_refs(PARENT.sub(b'', head))]
+        visited = { page }
+        while stack:
+            ref = stack.pop()
+            if ref in visited or ref not in objects: continue
+            visited.add(ref)
+            obj = objects[ref]
+            if PAGE_NODE.search(obj.head): continue
+            if obj.stream and FORM.search(obj.head): size += len(obj.stream)
+            stack.extend( find_refs(PARENT.sub(b'', obj.head)) )
+        result[num] = size
+    return result
+
+def deduplicate(objects: dict[tuple[int,int],PdfObject]) -> dict[tuple[int,int],tuple[int,int]]:
+    # Merges objects with the same content, until merging makes no more objects identical
+    mapping = {}
+
+    def resolve(ref):
+        while ref in mapping: ref = mapping[ref]
+        return ref
+
+    while True:
+        groups = {}
+        changed = False
+        for ref in sorted(objects):
+            obj = objects[ref]
+            if ref in mapping or obj.fixed: continue
+            key = (rewrite_refs(obj.head, resolve).strip(), obj.digest, len(obj.stream))
+            target = groups.setdefault(key, ref)
+            if target != ref:
+                mapping[ref] = target
+                changed = True
+        if not changed: break
+    return { ref: resolve(ref) for ref in mapping }
+
+def optimize(data: bytes) -> Optional[tuple[bytes,int]]:
+    # Returns the rewritten file and the number of merged objects, or None if it cannot be optimized
+    if UNSUPPORTED.search(data): return None
+    trailers = TRAILER.findall(data)
+    if not trailers: return None
+    header, objects = parse_objects(data)
+    if not objects: return None
+    mapping = deduplicate(objects)
+    if not mapping: return None
+    resolve = lambda ref: mapping.get(ref, ref)
+
+    out = bytearray(header)
+    offsets = {}
+    for ref in sorted(objects):
+        if ref in mapping: continue
+        num, gen = ref
+        offsets[num] = (len(out), gen)
+        out += b'%d %d obj' % ref + rewrite_refs(objects[ref].head, resolve) + objects[ref].stream + b'endobj\n'
+
+    size = max(num for num, _ in objects) + 1
+    gens = { num: gen for num, gen in objects }
+    free = [num for num in range(1, size) if num not in offsets]
+    xref_offset = len(out)
+    out += b'xref\n0 %d\n' % size
+    out += b'%010d 65535 f\r\n' % (free[0] if free else 0)
+    next_free = { num: (free[i+1] if i + 1 < len(free) else 0) for i, num in enumerate(free) }
+    for num in range(1, size):
+        if num in offsets:
+            out += b'%010d %05d n\r\n' % offsets[num]
+        else:
+            out += b'%010d %05d f\r\n' % (next_free[num], min(gens.get(num, 0) + 1, 65535))
+
+    trailer = rewrite_refs(trailers[-1], resolve)
+    trailer = re.sub(rb'/(?:Prev|XRefStm)\s+\d+', b'', trailer)
+    trailer = re.sub(rb'/Size\s+\d+', b'/Size %d' % size, trailer)
+    out += b'trailer\n' + trailer + b'\nstartxref\n%d\n%%%%EOF\n' % xref_offset
+    return bytes(out), len(mapping)
+
+def optimize_file(filename: str) -> Optional[tuple[int,int,int]]:
+    # Returns (bytes before, bytes after, merged objects), or None if the file was left as is
+    with open(filename, 'rb') as f:
+        data = f.read()
+    result = optimize(data)
+    if result is None or len(result[0]) >= len(data): return None
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(result[0])
+    os.replace(tmp, filename)
+    return len(data), len(result[0]), result[1]
@@ -1,9 +1,14 @@
-import os, tempfile, subprocess, shutil, sys
-import argparse, asyncio, operator, contextlib
+import os, tempfile, sys, threading
+import argparse, asyncio, contextlib
 from pathlib import Path
 from enum import Enum
+from typing import Optional
 import pdftowrite.utils as utils
-from pdftowrite.docs import Background
+import pdftowrite.schedule as schedule
+import pdftowrite.pgzip as pgzip
+import pdftowrite.docs
+from pdftowrite.docs import SVG_NS, XLINK_NS, Background, Page, Document
+from subprocess import DEVNULL
 from pdftowrite import __version__
 
 PACKAGE_DIR = Path(os.path.dirname(__file__))
@@ -44,18 +49,35 @@ def arg_parser():
                         help='Specify output filename')
     parser.add_argument('-f', '--force', action='store_true',
                         help='Overwrite existing files without asking')
+    parser.add_argument('--update', metavar='EXISTING', action='store', type=str, default=None,
+                        help='Update an existing Write document, converting only new or changed pages')
     parser.add_argument('-m', '--mode', type=Mode, default=Mode.MIXED, choices=list(Mode),
                         help='Specify render mode (default: mixed)')
     parser.add_argument('-C', '--no-compat-mode', action='store_true',
                         help='Turn off Write compatibility mode')
     parser.add_argument('-d', '--dpi', type=int, default=96,
                         help='Specify resolution for bitmaps and rasterized filters (default: 96)')
+    parser.add_argument('-O', '--optimize', action='store_true',
+                        help='Minify backgrounds and compact text layers')
+    parser.add_argument('--precision', action='store', type=float, default=0.0001,
+                        help='Specify coordinate precision relative to page size for --optimize (default: 0.0001)')
+    parser.add_argument('-I', '--optimize-images', action='store_true',
+                        help='Downsample embedded images to --dpi and re-encode them as JPEG or PNG')
+    parser.add_argument('--image-quality', action='store', type=int, default=85,
+                        help='Specify JPEG quality for --optimize-images (default: 85)')
     parser.add_argument('-g', '--pages', action='store', type=str, default='all',
                         help='Specify pages to convert (e.g. "1 2 3", "1-3") (default: all)')
     parser.add_argument('-u', '--nodup-pages', action='store', type=str, default='all',
                         help='Specify no-dup pages (e.g. "1 2 3", "1-3") (default: all)')
     parser.add_argument('-Z', '--nozip', action='store_true',
                         help='Do not compress output')
+    parser.add_argument('--volume-size', metavar='SIZE', action='store', type=utils.parse_volume_size, default=None,
+                        help='Split output into volumes of SIZE pages, or SIZE megabytes of uncompressed SVG '
+                             'if it ends with "MB" (e.g. example-001.svgz)')
+    parser.add_argument('--zip-level', action='store', type=int, default=6, choices=range(1, 10),
+                        metavar='{1-9}', help='Specify compression level (default: 6)')
+    parser.add_argument('--zip-threads', action='store', type=int, default=0,
+                        help='Specify number of compression threads (default: number of CPUs)')
     parser.add_argument('-s', '--scale', action='store', type=float, default=1.0,
                         help='Scale page size (default: 1.0)')
     parser.add_argument('-x', action='store', type=float, default=10.0,
@@ -68,71 +90,422 @@ def arg_parser():
                         help='Specify y rulling (default: 40.0)')
     parser.add_argument('-l', '--margin-left', action='store', type=float, default=100.0,
                         help='Specify margin left (default: 100.0)')
+    parser.add_argument('--max-inflight', metavar='N', action='store', type=int, default=0,
+                        help='Specify the maximum number of pages converted ahead of the page being written '
+                             '(default: 4 times the number of workers)')
+    parser.add_argument('--memory-budget', metavar='MB', action='store', type=int, default=512,
+                        help='Specify memory in MiB for converted pages waiting to be written, beyond which '
+                             'they are kept in temporary files (default: 512)')
+    parser.add_argument('--plan', action='store_true',
+                        help='Print the estimated page schedule and exit')
+    utils.add_limit_args(parser)
     parser.add_argument('-p', '--papercolor', action='store', type=str, default='#FFFFFF',
                         help='Specify paper color (default: #FFFFFF)')
     parser.add_argument('-r', '--rulecolor', action='store', type=str, default='#9F0000FF',
                         help='Specify rule color (default: #9F0000FF)')
     return parser
 
-def process_page(filename: str, page_num: int, output_dir: str, ns: argparse.Namespace) -> Background:
+def process_page(filename: str, page_num: int, output_dir: str, ns: argparse.Namespace,
+                 pdf_page: Optional[int] = None) -> Background:
+    # pdf_page is the page within filename, if it is not the page_num of the document
+    pdf_page = pdf_page or page_num
     output = str(Path(output_dir) / f'output-{page_num}.svg')
     opts = ['--pdf-poppler'] if ns.mode is Mode.POPPLER or ns.mode is Mode.MIXED else []
     utils.inkscape_run([
         *opts,
-        f'--pdf-page={page_num}',
+        f'--pdf-page={pdf_page}',
         f'--export-dpi={ns.dpi}',
         '--export-plain-svg',
         '-o', output,
         filename
-    ])
+    ], ns.limits)
 
     text_layer_svg = None
     if ns.mode is Mode.MIXED:
         text_layer_output = str(Path(output_dir) / f'output-{page_num}-text.svg')
         utils.inkscape_run([
-            f'--pdf-page={page_num}',
+            f'--pdf-page={pdf_page}',
             f'--export-dpi={ns.dpi}',
             '--export-plain-svg',
             '-o', text_layer_output,
             filename
-        ])
+        ], ns.limits)
         with open(text_layer_output, 'r') as f:
             text_layer_svg = f.read()
 
     with open(output, 'r') as f:
         svg = f.read()
-        return Background(page_num, svg, text_layer_svg, not ns.no_compat_mode)
+        return Background(page_num, svg, text_layer_svg, not ns.no_compat_mode,
+                          optimize=ns.optimize, precision=ns.precision,
+                          image_dpi=ns.dpi if ns.optimize_images else None, image_quality=ns.image_quality,
+                          limits=ns.limits)
 
-async def convert_to_pages(filename: str, page_nums: list[int], ns: argparse.Namespace) -> list[Background]:
+def fallback_page(filename: str, page_num: int, output_dir: str, ns: argparse.Namespace,
+                  policy: utils.FailurePolicy) -> Background:
+    try:
+        width, height = utils.pdf_page_size_pt(filename, page_num, ns.limits)
+    except Exception:
+        width, height = 612.0, 792.0 # Letter
+    width_px = utils.px(f'{width}pt')
+    height_px = utils.px(f'{height}pt')
+    image = ''
+    if policy is utils.FailurePolicy.RASTER:
+        prefix = str(Path(output_dir) / f'output-{page_num}-raster')
+        utils.check_call(['pdftoppm', '-f', str(page_num), '-l', str(page_num), '-r', str(ns.dpi),
+                          '-png', '-singlefile', filename, prefix], ns.limits, stdout=DEVNULL, stderr=DEVNULL)
+        with open(prefix + '.png', 'rb') as f:
+            encoded = utils.encode_image_uri(f.read())
+        image = (f'<image width="{width_px}" height="{height_px}" preserveAspectRatio="none" '
+                 f'xlink:href="data:image/png;base64,{encoded}" />')
+    svg = (f'<svg xmlns="{SVG_NS}" xmlns:xlink="{XLINK_NS}" width="{width_px}" height="{height_px}" '
+           f'viewBox="0 0 {width_px} {height_px}">{image}</svg>')
+    return Background(page_num, svg, None, False)
+
+def process_page_safely(filename: str, page_num: int, output_dir: str, ns: argparse.Namespace,
+                        failures: list, pool: Optional['remote.WorkerPool'] = None) -> Background:
+    if pool:
+        render = lambda: pool.convert_page(filename, page_num, ns)
+    else:
+        render = lambda: process_page(filename, page_num, output_dir, ns)
+    fallback = lambda policy: fallback_page(filename, page_num, output_dir, ns, policy)
+    return utils.render_safely(render, fallback, page_num, ns.retries, ns.on_failure, failures)
+
+def page_stats(page: Background) -> list[str]:
     result = []
-    with tempfile.TemporaryDirectory() as tmpdir:
-        loop = asyncio.get_running_loop()
-        tasks = []
-        for num in page_nums:
-            task = loop.run_in_executor(None, process_page, filename, num, tmpdir, ns)
-            tasks.append(task)
-        result = await asyncio.gather(*tasks)
-    return sorted(result, key=operator.attrgetter('page_num'))
-
-def generate_document(pages: list[Background], nodup_pages: set[int], vars: dict[str,str], ns: argparse.Namespace) -> None:
-    page_tmp = get_page_template()
-    page_results = []
-    ruleline_attribs = vars['ruleline-attribs']
-    for page in pages:
-        width_px = utils.px(page.width) * ns.scale
-        height_px = utils.px(page.height) * ns.scale
-        page.width = f'{width_px}px'
-        page.height = f'{height_px}px'
-        vars['width'] = page.width
-        vars['height'] = page.height
-        vars['ruleline-classes'] = 'write-no-dup' if page.page_num in nodup_pages else ''
-        vars['ruleline-attribs'] = ruleline_attribs + f' data-pdf-page="{page.page_num}"'
-        vars['body'] = page.svg
-        text = utils.apply_vars(page_tmp, vars)
-        page_results.append(text)
-    doc_tmp = get_doc_template()
-    body = '\n\n'.join(page_results)
-    return utils.apply_vars(doc_tmp, { 'body': body })
+    if page.image_stats:
+        count, before, after = page.image_stats
+        ratio = (1 - after / before) * 100 if before else 0.0
+        result.append(f'page #{page.page_num}: {count} images {before} -> {after} bytes (-{ratio:.1f}%)')
+    if page.optimize_stats:
+        before, after = page.optimize_stats
+        ratio = (1 - after / before) * 100 if before else 0.0
+        result.append(f'page #{page.page_num}: background {before} -> {after} bytes (-{ratio:.1f}%)')
+    if page.text_layer_stats:
+        before, after, count, new_count = page.text_layer_stats
+        ratio = (1 - after / before) * 100 if before else 0.0
+        result.append(f'page #{page.page_num}: text layer {before} -> {after} bytes (-{ratio:.1f}%), '
+                      f'{count} -> {new_count} elements')
+    return result
+
+class Spool:
+    # Converted page texts waiting to be written. Beyond the budget, they are kept in files.
+    def __init__(self, output_dir: str, budget: int):
+        self.output_dir = output_dir
+        self.budget = budget
+        self.size = 0
+        self.spilled = 0
+        self.pages = {}
+        self.lock = threading.Lock()
+
+    def __path(self, num: int) -> str:
+        return str(Path(self.output_dir) / f'spool-{num}.svg')
+
+    def put(self, num: int, text: str) -> None:
+        with self.lock:
+            if self.size + len(text) <= self.budget:
+                self.size += len(text)
+                self.pages[num] = text
+                return
+        with open(self.__path(num), 'w') as f:
+            f.write(text)
+        with self.lock:
+            self.spilled += 1
+            self.pages[num] = None
+
+    def take(self, num: int) -> str:
+        with self.lock:
+            text = self.pages.pop(num)
+            if text is not None:
+                self.size -= len(text)
+                return text
+        with open(self.__path(num), 'r') as f:
+            text = f.read()
+        os.remove(self.__path(num))
+        return text
+
+class PageDispatcher:
+    # Submits the pages in the given order (e.g. longest first), but only those within
+    # max_inflight pages of the next page to be written, so finished pages do not pile up
+    def __init__(self, order: list[int], write_order: list[int], max_inflight: int, submit):
+        self.write_order = write_order
+        self.max_inflight = max_inflight
+        self.submit = submit
+        self.written = 0
+        self.tasks = {}
+        window = set(write_order[:max_inflight])
+        for num in order:
+            if num in window: self.tasks[num] = submit(num)
+
+    async def take(self, num: int):
+        if num not in self.tasks: self.tasks[num] = self.submit(num)
+        result = await self.tasks.pop(num)
+        # The window slides by one page
+        index = self.written + self.max_inflight
+        if index < len(self.write_order) and self.write_order[index] not in self.tasks:
+            self.tasks[self.write_order[index]] = self.submit(self.write_order[index])
+        self.written += 1
+        return result
+
+    def cancel(self) -> list[asyncio.Future]:
+        for task in self.tasks.values(): task.cancel()
+        return list(self.tasks.values())
+
+def convert_page(filename: str, page_num: int, output_dir: str, ns: argparse.Namespace, failures: list,
+                 pool: Optional['remote.WorkerPool'], spool: Spool, hashes: dict[int,Optional[str]],
+                 nodup_pages: set[int], vars: dict[str,str]) -> list[str]:
+    # Only the text of the page is kept, and the stats are returned to be printed in page order
+    page = process_page_safely(filename, page_num, output_dir, ns, failures, pool)
+    if all(f[0] != page_num for f in failures):
+        # Only --update hashes the pages beforehand
+        page.pdf_hash = hashes[page_num] if page_num in hashes else pdf_page_digest_safely(filename, page_num)
+    spool.put(page_num, generate_page(page, nodup_pages, vars, ns))
+    return page_stats(page)
+
+def convert_to_pages(filename: str, order: list[int], write_order: list[int], output_dir: str,
+                     ns: argparse.Namespace, failures: list, spool: Spool, hashes: dict[int,Optional[str]],
+                     nodup_pages: set[int], vars: dict[str,str],
+                     pool: Optional['remote.WorkerPool'] = None) -> PageDispatcher:
+    loop = asyncio.get_running_loop()
+    max_inflight = ns.max_inflight if ns.max_inflight > 0 else schedule.default_workers() * 4
+    submit = lambda num: loop.run_in_executor(None, convert_page, filename, num, output_dir, ns, failures,
+                                              pool, spool, hashes, nodup_pages, vars)
+    return PageDispatcher(order, write_order, max_inflight, submit)
+
+def pdf_page_digest_safely(filename: str, page_num: int) -> Optional[str]:
+    try:
+        return utils.pdf_page_digest(filename, page_num)
+    except Exception:
+        return None
+
+async def hash_pages(filename: str, page_nums: list[int]) -> dict[int,Optional[str]]:
+    loop = asyncio.get_running_loop()
+    tasks = [loop.run_in_executor(None, pdf_page_digest_safely, filename, num) for num in page_nums]
+    return dict(zip(page_nums, await asyncio.gather(*tasks)))
+
+class UpdateEntry:
+    def __init__(self, page_num: Optional[int], existing: Optional[Page], convert: bool):
+        self.page_num = page_num # PDF page number, None for pages without a PDF page
+        self.existing = existing # Existing page to keep, or to take annotations from
+        self.convert = convert
+        self.followers = [] # Existing pages without a PDF page placed after this page
+
+def plan_update(existing: Document, page_nums: list[int], hashes: dict[int,Optional[str]]) -> list[UpdateEntry]:
+    mapped = [page for page in existing.pages if page.pdf_page is not None]
+    used = set()
+
+    def take(pred) -> Optional[Page]:
+        for page in mapped:
+            if id(page) not in used and pred(page):
+                used.add(id(page))
+                return page
+        return None
+
+    matches = {}
+    for num in page_nums:
+        h = hashes[num]
+        if h is None: continue
+        page = take(lambda p: p.pdf_page == num and p.pdf_hash == h)
+        if page: matches[num] = page
+    for num in page_nums:
+        h = hashes[num]
+        if num in matches or h is None: continue
+        page = take(lambda p: p.pdf_hash == h)
+        if page: matches[num] = page
+
+    entries = []
+    prev = None
+    for num in page_nums:
+        if num in matches:
+            entries.append(UpdateEntry(num, matches[num], False))
+            prev = matches[num].pdf_page
+        else:
+            # A changed page replaces the page following the previous match,
+            # and the annotations of the old version are moved to the new one
+            old_num = prev + 1 if prev is not None else num
+            entries.append(UpdateEntry(num, take(lambda p: p.pdf_page == old_num), True))
+            prev = old_num
+
+    by_existing = { id(e.existing): e for e in entries if e.existing }
+    anchor = None
+    leading = []
+    for page in existing.pages:
+        if page.pdf_page is not None:
+            if id(page) in by_existing:
+                anchor = by_existing[id(page)]
+                continue
+            if not page.annotations: continue
+            print(f'warning: keeping annotated page #{page.page_num} whose PDF page was removed', file=sys.stderr)
+        # Kept in place, after the preceding page that is still in the document
+        entry = UpdateEntry(None, page, False)
+        if anchor: anchor.followers.append(entry)
+        else: leading.append(entry)
+    return leading + entries
+
+def generate_page(page: Background, nodup_pages: set[int], vars: dict[str,str], ns: argparse.Namespace) -> str:
+    vars = dict(vars)
+    width_px = utils.px(page.width) * ns.scale
+    height_px = utils.px(page.height) * ns.scale
+    page.width = f'{width_px}px'
+    page.height = f'{height_px}px'
+    vars['width'] = page.width
+    vars['height'] = page.height
+    vars['ruleline-classes'] = 'write-no-dup' if page.page_num in nodup_pages else ''
+    vars['ruleline-attribs'] += f' data-pdf-page="{page.page_num}"'
+    if page.pdf_hash:
+        vars['ruleline-attribs'] += f' data-pdf-hash="{page.pdf_hash}"'
+    vars['body'] = page.svg
+    return utils.apply_vars(get_page_template(), vars)
+
+async def finish_page(dispatcher: PageDispatcher, spool: Spool, num: int) -> str:
+    for line in await dispatcher.take(num):
+        print(line)
+    return spool.take(num)
+
+async def generate_pages(dispatcher: PageDispatcher, spool: Spool, page_nums: list[int]):
+    for num in page_nums:
+        yield await finish_page(dispatcher, spool, num)
+
+async def generate_updated_pages(dispatcher: PageDispatcher, spool: Spool, entries: list[UpdateEntry],
+                                 ns: argparse.Namespace):
+    filename = ns.file[0]
+    for entry in entries:
+        for e in [entry, *entry.followers]:
+            if e.convert:
+                text = await finish_page(dispatcher, spool, e.page_num)
+                if e.existing and e.existing.annotations:
+                    page = Page(e.page_num, text)
+                    for el in e.existing.annotations:
+                        page.write_content.append(el)
+                    text = page.svg
+            else:
+                if e.page_num is not None:
+                    e.existing.ruleline.set('data-pdf-file', filename)
+                    e.existing.ruleline.set('data-pdf-page', str(e.page_num))
+                elif e.existing.pdf_page is not None:
+                    # Its PDF page was removed
+                    for name in ('data-pdf-file', 'data-pdf-page', 'data-pdf-hash'):
+                        e.existing.ruleline.attrib.pop(name, None)
+                text = e.existing.svg
+            yield text
+
+@contextlib.contextmanager
+def open_output(output: str, ns: argparse.Namespace):
+    tmp_output = output + '.tmp'
+    try:
+        with open(tmp_output, 'w' if ns.nozip else 'wb') as f:
+            if ns.nozip:
+                yield f
+            else:
+                with pgzip.ParallelGzipWriter(f, ns.zip_level, ns.zip_threads) as writer:
+                    yield writer
+        os.replace(tmp_output, output)
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_output)
+
+def volume_output(output: str, num: int, ns: argparse.Namespace) -> str:
+    if not ns.volume_size: return output
+    path = Path(output)
+    return str(path.with_name(f'{path.stem}-{num:03d}{path.suffix}'))
+
+def existing_volumes(output: str, ns: argparse.Namespace) -> list[str]:
+    if not ns.volume_size:
+        return [output] if Path(output).exists() else []
+    path = Path(output)
+    return sorted(str(p) for p in path.parent.glob(f'{path.stem}-[0-9][0-9][0-9]{path.suffix}'))
+
+def volume_full(pages: int, size: int, text: str, ns: argparse.Namespace) -> bool:
+    if not ns.volume_size or pages == 0: return False
+    max_pages, max_size = ns.volume_size
+    if max_pages: return pages >= max_pages
+    return size + len(text.encode('utf-8')) > max_size
+
+async def write_document(output: str, page_texts, ns: argparse.Namespace) -> list[str]:
+    # Pages are written (and compressed) in page order as soon as they are ready,
+    # and each volume is completed as soon as its last page is written
+    header, _, footer = get_doc_template().partition('{body}')
+    outputs = []
+    with contextlib.ExitStack() as stack:
+        f = None
+        pages = size = 0
+        async for text in page_texts:
+            if f is None or volume_full(pages, size, text, ns):
+                if f is not None:
+                    f.write(footer)
+                    stack.close()
+                outputs.append( volume_output(output, len(outputs) + 1, ns) )
+                f = stack.enter_context(open_output(outputs[-1], ns))
+                f.write(header)
+                pages = size = 0
+            else:
+                f.write('\n\n')
+            f.write(text)
+            pages += 1
+            size += len(text.encode('utf-8')) if ns.volume_size else 0
+        if f is None:
+            outputs.append( volume_output(output, 1, ns) )
+            f = stack.enter_context(open_output(outputs[-1], ns))
+            f.write(header)
+        f.write(footer)
+    return outputs
+
+async def convert_document(filename: str, output: str, page_nums: list[int], nodup_pages: set[int],
+                           vars: dict[str,str], ns: argparse.Namespace) -> None:
+    failures = []
+    hashes = {}
+    if ns.update:
+        hashes = await hash_pages(filename, page_nums)
+        svg = utils.read_svg(ns.update)
+        existing = Document(svg, set(range(1, pdftowrite.docs.num_pages(svg) + 1)))
+        entries = plan_update(existing, page_nums, hashes)
+        convert_nums = [e.page_num for e in entries if e.convert]
+        print(f'{len(convert_nums)} of {len(page_nums)} page(s) are new or changed')
+    else:
+        convert_nums = page_nums
+    # The most expensive pages are dispatched first so they do not dominate the makespan
+    costs = schedule.pdf_page_costs(filename, convert_nums)
+    if ns.plan:
+        schedule.print_plan(costs, schedule.default_workers())
+        return
+
+    existing_outputs = existing_volumes(output, ns)
+    for existing_output in existing_outputs:
+        if not ns.force and not utils.query_yn(f'Overwrite?: {existing_output}'): return
+
+    pool = None
+    if ns.workers:
+        # Only remote rendering needs the HTTP modules
+        import pdftowrite.remote as remote
+        pool = remote.WorkerPool.from_spec(ns.workers, timeout=ns.remote_timeout)
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            if ns.update:
+                write_order = [e.page_num for entry in entries for e in [entry, *entry.followers] if e.convert]
+            else:
+                write_order = page_nums
+            spool = Spool(tmpdir, ns.memory_budget << 20)
+            dispatcher = convert_to_pages(filename, schedule.longest_first(costs), write_order, tmpdir, ns,
+                                          failures, spool, hashes, nodup_pages, vars, pool)
+            if ns.update:
+                page_texts = generate_updated_pages(dispatcher, spool, entries, ns)
+            else:
+                page_texts = generate_pages(dispatcher, spool, page_nums)
+            try:
+                outputs = await write_document(output, page_texts, ns)
+            finally:
+                # Do not leave pages running when the output failed
+                await asyncio.gather(*dispatcher.cancel(), return_exceptions=True)
+            if spool.spilled:
+                print(f'{spool.spilled} page(s) were kept in temporary files until written')
+    finally:
+        if pool: pool.close()
+    # Volumes of a previous conversion that are not part of this one
+    for existing_output in existing_outputs:
+        if existing_output not in outputs:
+            os.remove(existing_output)
+            print(f'removed stale volume: {existing_output}')
+    utils.print_peak_memory()
+    utils.print_failures(failures)
 
 def run(args):
     parser = arg_parser()
@@ -160,28 +533,24 @@ def run(args):
     page_nums = sorted( utils.parse_range(ns.pages, num_pages) )
     nodup_page_nums = utils.parse_range(ns.nodup_pages, num_pages)
 
-    loop = asyncio.get_event_loop()
-    pages = loop.run_until_complete( convert_to_pages(filename, page_nums, ns) )
-    loop.close()
-
-    doc = generate_document(pages, nodup_page_nums, vars, ns)
-
     suffix = '.svg' if ns.nozip else '.svgz'
-    output = ns.output if ns.output else str(Path(filename).with_suffix(suffix))
-    tmp_output = output if ns.nozip else output + '.tmp'
-    if not ns.force and Path(tmp_output).exists():
-        if not utils.query_yn(f'Overwrite?: {tmp_output}'): return
-    with open(tmp_output, 'w') as f:
-        f.write(doc)
-    if not ns.nozip:
-        if not ns.force and Path(tmp_output + '.gz').exists():
-            if not utils.query_yn(f'Overwrite?: {tmp_output}.gz'): return
-        subprocess.check_call(['gzip', '-f', tmp_output])
-        if not ns.force and Path(output).exists():
-            if not utils.query_yn(f'Overwrite?: {output}'): return
-        with contextlib.suppress(FileNotFoundError):
-            os.remove(output)
-        shutil.move(tmp_output + '.gz', output)
+    if ns.output:
+        output = ns.output
+    elif ns.update:
+        output = ns.update
+        # The document is replaced, so it keeps its compression
+        ns.nozip = Path(output).suffix != '.svgz'
+    else:
+        output = str(Path(filename).with_suffix(suffix))
+
+    ns.limits = utils.set_limits(ns.timeout, ns.memory_limit, ns.cpu_limit)
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete( convert_document(filename, output, page_nums, nodup_page_nums, vars, ns) )
+    finally:
+        # Commands run in their own sessions, so they do not get the interrupt themselves
+        utils.kill_processes()
+        loop.close()
 
 def main():
     run(sys.argv[1:])
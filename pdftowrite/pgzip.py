@@ -0,0 +1,114 @@
+import os, struct, threading, queue, zlib, contextlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union
+
+BLOCK_SIZE = 1 << 20
+DICT_SIZE = 1 << 15 # Window size of deflate
+READ_SIZE = 1 << 20
+
+def compress_block(block: bytes, zdict: bytes, level: int, last: bool) -> bytes:
+    if zdict:
+        comp = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, 9, zlib.Z_DEFAULT_STRATEGY, zdict)
+    else:
+        comp = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, 9)
+    # Non-final blocks end at a byte boundary, so the raw deflate streams can be concatenated
+    return comp.compress(block) + comp.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+# Writes a standard single-member gzip stream whose blocks are compressed in parallel.
+# Like pigz, each block is compressed with the last 32 KiB of the previous block as the
+# dictionary, so the ratio stays close to that of serial gzip.
+class ParallelGzipWriter:
+    def __init__(self, fileobj, level: int = 6, threads: int = 0):
+        self.fileobj = fileobj
+        self.level = level
+        self.threads = threads if threads > 0 else (os.cpu_count() or 1)
+        self.executor = ThreadPoolExecutor(self.threads)
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.zdict = b''
+        self.crc = 0
+        self.size = 0
+        self.closed = False
+        # Header: magic, deflate, no flags, no mtime, no extra flags, unknown OS
+        self.fileobj.write(b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff')
+
+    def write(self, data: Union[str,bytes]) -> None:
+        if isinstance(data, str): data = data.encode('utf-8')
+        self.buffer += data
+        while len(self.buffer) >= BLOCK_SIZE:
+            block = bytes(self.buffer[:BLOCK_SIZE])
+            del self.buffer[:BLOCK_SIZE]
+            self.__submit(block, False)
+
+    def __submit(self, block: bytes, last: bool) -> None:
+        self.crc = zlib.crc32(block, self.crc)
+        self.size += len(block)
+        self.pending.append( self.executor.submit(compress_block, block, self.zdict, self.level, last) )
+        self.zdict = block[-DICT_SIZE:]
+        # Bound the memory held by blocks waiting to be written
+        while self.pending and (self.pending[0].done() or len(self.pending) > self.threads * 2):
+            self.fileobj.write( self.pending.popleft().result() )
+
+    def close(self) -> None:
+        if self.closed: return
+        self.closed = True
+        self.__submit(bytes(self.buffer), True)
+        self.buffer = bytearray()
+        while self.pending:
+            self.fileobj.write( self.pending.popleft().result() )
+        self.executor.shutdown()
+        self.fileobj.write( struct.pack('<II', self.crc, self.size & 0xffffffff) )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.executor.shutdown(cancel_futures=True)
+
+def decompress_file(filename: str) -> bytes:
+    # Inflating is inherently serial, so reading the file runs in a separate thread
+    chunks = queue.Queue(maxsize=8)
+    stop = threading.Event()
+
+    def read():
+        try:
+            with open(filename, 'rb') as f:
+                while not stop.is_set():
+                    chunk = f.read(READ_SIZE)
+                    chunks.put(chunk)
+                    if not chunk: break
+        except BaseException as e:
+            chunks.put(e)
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    try:
+        result = []
+        decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        while True:
+            chunk = chunks.get()
+            if isinstance(chunk, BaseException): raise chunk
+            if not chunk: break
+            data = chunk
+            while data:
+                result.append( decomp.decompress(data) )
+                data = b''
+                # Concatenated members are allowed by the format
+                if decomp.eof and decomp.unused_data:
+                    data = decomp.unused_data
+                    decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if not decomp.eof:
+            raise EOFError(f'Compressed file ended before the end-of-stream marker was reached: {filename}')
+        result.append( decomp.flush() )
+        return b''.join(result)
+    finally:
+        # On errors (e.g. a file that is still being saved), the reader may be waiting for room in
+        # the queue. Emptying the queue lets it see the stop flag and close the file.
+        stop.set()
+        with contextlib.suppress(queue.Empty):
+            while True: chunks.get_nowait()
+        reader.join()
@@ -0,0 +1,347 @@
+import argparse, base64, collections, json, os, re, subprocess, sys, tempfile, threading, hmac, secrets
+import xml.etree.ElementTree as ET
+import urllib.request, urllib.error
+from enum import Enum
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from typing import Optional
+import pdftowrite.utils as utils
+from pdftowrite import __version__
+
+HEARTBEAT_INTERVAL = 5.0
+HEARTBEAT_TIMEOUT = 3.0
+TOKEN_HEADER = 'X-Worker-Token'
+TOKEN_ENV = 'PDFTOWRITE_WORKER_TOKEN'
+# Options that only make sense on the client
+LOCAL_OPTIONS = { 'workers', 'remote_timeout', 'file', 'output', 'force', 'update', 'plan', 'pages', 'nodup_pages',
+                  'volume_size', 'max_inflight', 'memory_budget', 'limits' }
+# Options that workers take from jobs, with their types. The others keep their defaults,
+# so a job cannot make a worker read a file of its choice (e.g. with --pdf-file).
+LIMIT_OPTIONS = { 'timeout': float, 'memory_limit': int, 'cpu_limit': int }
+PDFTOWRITE_OPTIONS = { 'mode': str, 'dpi': int, 'no_compat_mode': bool, 'optimize': bool, 'precision': float,
+                       'optimize_images': bool, 'image_quality': int, **LIMIT_OPTIONS }
+WRITETOPDF_OPTIONS = { 'annot': bool, 'scale': float, **LIMIT_OPTIONS }
+URL_FUNC = re.compile(r'url\s*\(\s*[\'"]?\s*([^\'")\s]*)')
+
+class RemoteError(Exception):
+    pass
+
+def encode_options(ns: argparse.Namespace) -> dict:
+    result = {}
+    for k, v in vars(ns).items():
+        if k in LOCAL_OPTIONS: continue
+        result[k] = v.value if isinstance(v, Enum) else v
+    return result
+
+class Worker:
+    def __init__(self, url: str, token: str):
+        self.url = url.rstrip('/')
+        self.token = token
+        self.alive = True
+        self.jobs = 0
+
+    def post(self, path: str, payload: dict, timeout: Optional[float]) -> bytes:
+        data = json.dumps(payload).encode('utf-8')
+        req = urllib.request.Request(self.url + path, data=data,
+                                     headers={ 'Content-Type': 'application/json', TOKEN_HEADER: self.token })
+        with urllib.request.urlopen(req, timeout=timeout) as res:
+            return res.read()
+
+    def heartbeat(self) -> bool:
+        try:
+            req = urllib.request.Request(self.url + '/health', headers={ TOKEN_HEADER: self.token })
+            with urllib.request.urlopen(req, timeout=HEARTBEAT_TIMEOUT) as res:
+                return res.status == 200
+        except (urllib.error.URLError, OSError):
+            return False
+
+class WorkerPool:
+    def __init__(self, urls: list[str], retries: int = 2, timeout: Optional[float] = None,
+                 token: Optional[str] = None):
+        token = token or os.environ.get(TOKEN_ENV, '')
+        self.workers = [Worker(url, token) for url in urls]
+        self.retries = retries
+        self.timeout = timeout
+        self.processes = []
+        self.cond = threading.Condition()
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self.__heartbeat, daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def from_spec(cls, spec: str, retries: int = 2, timeout: Optional[float] = None) -> 'WorkerPool':
+        # "local:N" starts N worker processes on this machine
+        if spec.startswith('local:'):
+            token = secrets.token_urlsafe()
+            processes = [start_local_worker(token) for _ in range(int(spec[len('local:'):]))]
+            pool = cls([url for _, url in processes], retries, timeout, token)
+            pool.processes = [proc for proc, _ in processes]
+            return pool
+        return cls([url if '://' in url else 'http://' + url for url in spec.split(',') if url], retries, timeout)
+
+    def close(self) -> None:
+        self.closed.set()
+        for proc in self.processes:
+            proc.terminate()
+            proc.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __heartbeat(self) -> None:
+        while not self.closed.wait(HEARTBEAT_INTERVAL):
+            for worker in self.workers:
+                alive = worker.heartbeat()
+                with self.cond:
+                    worker.alive = alive
+                    self.cond.notify_all()
+
+    def __acquire(self, exclude: set[int]) -> Optional[Worker]:
+        with self.cond:
+            candidates = [w for w in self.workers if w.alive and id(w) not in exclude]
+            if not candidates:
+                candidates = [w for w in self.workers if w.alive]
+            if not candidates: return None
+            worker = min(candidates, key=lambda w: w.jobs)
+            worker.jobs += 1
+            return worker
+
+    def __release(self, worker: Worker, alive: bool) -> None:
+        with self.cond:
+            worker.jobs -= 1
+            if not alive: worker.alive = False
+            self.cond.notify_all()
+
+    def request(self, path: str, payload: dict) -> bytes:
+        tried = set()
+        error = None
+        for _ in range(self.retries + 1):
+            worker = self.__acquire(tried)
+            if worker is None:
+                raise RemoteError('No alive workers') from error
+            tried.add(id(worker))
+            try:
+                result = worker.post(path, payload, self.timeout)
+                self.__release(worker, True)
+                return result
+            except urllib.error.HTTPError as e:
+                # The worker is alive, but the job failed there
+                error = RemoteError(f'{worker.url}: {e.read().decode("utf-8", "replace")}')
+                self.__release(worker, True)
+            except (urllib.error.URLError, OSError) as e:
+                error = RemoteError(f'{worker.url}: {e}')
+                self.__release(worker, False)
+        raise error
+
+    def convert_page(self, filename: str, page_num: int, ns: argparse.Namespace) -> 'Background':
+        from pdftowrite.docs import Background
+        with tempfile.TemporaryDirectory() as tmpdir:
+            page_pdf = str(Path(tmpdir) / 'page.pdf')
+            utils.check_call(['pdfseparate', '-f', str(page_num), '-l', str(page_num), filename, page_pdf],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            with open(page_pdf, 'rb') as f:
+                pdf = base64.b64encode(f.read()).decode('ascii')
+        res = json.loads( self.request('/pdftowrite', {
+            'page_num': page_num,
+            'options': encode_options(ns),
+            'pdf': pdf,
+        }) )
+        page = Background.load(page_num, res['svg'])
+        page.optimize_stats = res.get('optimize_stats')
+        page.text_layer_stats = res.get('text_layer_stats')
+        page.image_stats = res.get('image_stats')
+        return page
+
+    def render_page(self, page: 'Page', output_dir: str, ns: argparse.Namespace, pdf_file: Optional[str]) -> str:
+        pdf = None
+        if ns.annot:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                page_pdf = str(Path(tmpdir) / 'page.pdf')
+                pdf_page = page.pdf_page or page.page_num
+                utils.check_call(['pdfseparate', '-f', str(pdf_page), '-l', str(pdf_page), pdf_file, page_pdf],
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                with open(page_pdf, 'rb') as f:
+                    pdf = base64.b64encode(f.read()).decode('ascii')
+            page.ruleline.set('data-pdf-file', 'page.pdf')
+            page.ruleline.set('data-pdf-page', '1')
+        data = self.request('/writetopdf', {
+            'page_num': page.page_num,
+            'options': encode_options(ns),
+            'svg': page.svg,
+            'pdf': pdf,
+        })
+        output = str(Path(output_dir) / f'page-{page.page_num}-remote.pdf')
+        with open(output, 'wb') as f:
+            f.write(data)
+        return output
+
+def start_local_worker(token: str) -> tuple[subprocess.Popen,str]:
+    proc = subprocess.Popen([sys.executable, '-m', 'pdftowrite.remote', '--host', '127.0.0.1', '--port', '0'],
+                            stdout=subprocess.PIPE, text=True, env={ **os.environ, TOKEN_ENV: token })
+    line = proc.stdout.readline()
+    url = utils.pattern_get(r'(http://\S+)', line, 1)
+    # Commands run by the worker (e.g. Inkscape) write to the same pipe, which must not fill up
+    threading.Thread(target=lambda: collections.deque(proc.stdout, maxlen=0), daemon=True).start()
+    return proc, url
+
+def decode_options(options: dict, allowed: dict[str,type], ns: argparse.Namespace) -> argparse.Namespace:
+    # Sets the allowed options of a job over the defaults in ns
+    for k, kind in allowed.items():
+        if k not in options: continue
+        v = options[k]
+        if v is None and getattr(ns, k) is None: pass
+        elif kind is float and type(v) is int: v = float(v)
+        elif type(v) is not kind: raise ValueError(f'Invalid option: {k}')
+        setattr(ns, k, v)
+    return ns
+
+def check_local_refs(svg: str) -> None:
+    # The renderers would load anything else from the file system or the network of the worker
+    for el in ET.fromstring(svg).iter():
+        tag = el.tag.rsplit('}', 1)[-1] if isinstance(el.tag, str) else ''
+        if tag == 'script': raise ValueError('Scripts are not allowed')
+        refs = [v.strip() for k, v in el.attrib.items() if k.rsplit('}', 1)[-1] in ('href', 'src')]
+        for text in [*el.attrib.values(), el.text if tag == 'style' else None]:
+            if not text: continue
+            if '@import' in text: raise ValueError('Imports are not allowed')
+            refs += URL_FUNC.findall(text)
+        for ref in refs:
+            if ref and not ref.startswith('#') and not ref.startswith('data:'):
+                raise ValueError(f'External reference: {ref[:100]}')
+
+def serve_pdftowrite(job: dict) -> tuple[str,bytes]:
+    import pdftowrite.pdftowrite as ptw
+    ns = decode_options(job['options'], PDFTOWRITE_OPTIONS, ptw.arg_parser().parse_args(['page.pdf']))
+    ns.mode = ptw.Mode(ns.mode)
+    ns.limits = utils.Limits(ns.timeout, ns.memory_limit, ns.cpu_limit)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = str(Path(tmpdir) / 'page.pdf')
+        with open(filename, 'wb') as f:
+            f.write(base64.b64decode(job['pdf']))
+        page = ptw.process_page(filename, job['page_num'], tmpdir, ns, pdf_page=1)
+    res = {
+        'page_num': page.page_num,
+        'svg': page.svg,
+        'optimize_stats': page.optimize_stats,
+        'text_layer_stats': page.text_layer_stats,
+        'image_stats': page.image_stats,
+    }
+    return 'application/json', json.dumps(res).encode('utf-8')
+
+def serve_writetopdf(job: dict) -> tuple[str,bytes]:
+    import pdftowrite.writetopdf as w2p
+    from pdftowrite.docs import Page
+    ns = decode_options(job['options'], WRITETOPDF_OPTIONS, w2p.arg_parser().parse_args(['page.svg']))
+    ns.limits = utils.Limits(ns.timeout, ns.memory_limit, ns.cpu_limit)
+    if ns.annot and not job.get('pdf'):
+        raise ValueError('Annotation jobs need the PDF page')
+    check_local_refs(job['svg'])
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if ns.annot:
+            ns.pdf_file = str(Path(tmpdir) / 'page.pdf')
+            with open(ns.pdf_file, 'wb') as f:
+                f.write(base64.b64decode(job['pdf']))
+        page = Page(job['page_num'], job['svg'])
+        output = w2p.process_page(page, tmpdir, ns)
+        with open(output, 'rb') as f:
+            return 'application/pdf', f.read()
+
+class Handler(BaseHTTPRequestHandler):
+    server_version = 'pdftowrite-worker/' + __version__
+    routes = { '/pdftowrite': serve_pdftowrite, '/writetopdf': serve_writetopdf }
+
+    def __authorized(self) -> bool:
+        token = self.headers.get(TOKEN_HEADER, '')
+        if hmac.compare_digest(token.encode('utf-8'), self.server.token.encode('utf-8')): return True
+        self.send_error(403)
+        return False
+
+    def do_GET(self):
+        if not self.__authorized(): return
+        if self.path != '/health':
+            self.send_error(404)
+            return
+        self.__send(200, 'application/json', json.dumps({ 'status': 'ok', 'jobs': self.server.jobs }).encode('utf-8'))
+
+    def do_POST(self):
+        if not self.__authorized(): return
+        route = self.routes.get(self.path)
+        if not route:
+            self.send_error(404)
+            return
+        length = self.headers.get('Content-Length', '')
+        if not length.isdigit():
+            self.send_error(411)
+            return
+        try:
+            job = json.loads( self.rfile.read(int(length)) )
+        except ValueError:
+            self.send_error(400)
+            return
+        with self.server.slots:
+            self.server.jobs += 1
+            try:
+                content_type, body = route(job)
+                status = 200
+            except Exception as e:
+                content_type, body = 'text/plain', repr(e).encode('utf-8')
+                status = 500
+            finally:
+                self.server.jobs -= 1
+        self.__send(status, content_type, body)
+
+    def __send(self, status: int, content_type: str, body: bytes):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description='Run a remote page worker for pdftowrite and writetopdf')
+    parser.add_argument('-v', '--version', action='version', version=__version__)
+    parser.add_argument('--host', action='store', type=str, default='127.0.0.1',
+                        help='Specify the address to listen on, 0.0.0.0 for all interfaces (default: 127.0.0.1)')
+    parser.add_argument('--port', action='store', type=int, default=8765,
+                        help='Specify the port to listen on, 0 for any free port (default: 8765)')
+    parser.add_argument('-j', '--jobs', action='store', type=int, default=os.cpu_count() or 1,
+                        help='Specify the number of concurrent jobs (default: number of CPUs)')
+    parser.add_argument('--token', action='store', type=str, default=os.environ.get(TOKEN_ENV),
+                        help=f'Specify the token that clients must send, also read from {TOKEN_ENV} '
+                             '(default: a random token)')
+    return parser
+
+def create_server(host: str, port: int, jobs: int, token: str) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.jobs = 0
+    server.slots = threading.BoundedSemaphore(jobs)
+    server.token = token
+    return server
+
+def run(args):
+    parser = arg_parser()
+    ns = parser.parse_args(args)
+    server = create_server(ns.host, ns.port, ns.jobs, ns.token or secrets.token_urlsafe())
+    host, port = server.server_address[:2]
+    print(f'listening on http://{host}:{port}', flush=True)
+    if not ns.token: print(f'token: {server.token}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        utils.kill_processes()
+        server.server_close()
+
+def main():
+    run(sys.argv[1:])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+import os, re, sys, heapq
+import xml.etree.ElementTree as ET
+import pdftowrite.utils as utils
+
+XLINK_NS = 'http://www.w3.org/1999/xlink'
+
+# Estimated cost units are roughly "bytes of content to process"
+PAGE_COST = 20000.0
+IMAGE_PIXEL_COST = 0.25
+SVG_NODE_COST = 200.0
+
+def default_workers() -> int:
+    # Same as the default executor of asyncio
+    return min(32, (os.cpu_count() or 1) + 4)
+
+def pdf_image_pixels(filename: str) -> dict[int,int]:
+    res = utils.check_output(['pdfimages', '-list', filename]).decode(sys.stdout.encoding)
+    result = {}
+    for line in res.splitlines():
+        match = re.match(r'^\s*(\d+)\s+\d+\s+\S+\s+(\d+)\s+(\d+)\s', line)
+        if not match: continue
+        page = int(match.group(1))
+        result[page] = result.get(page, 0) + int(match.group(2)) * int(match.group(3))
+    return result
+
+def pdf_content_sizes(filename: str) -> dict[int,int]:
+    import pdftowrite.pdfopt as pdfopt
+    with open(filename, 'rb') as f:
+        return pdfopt.page_content_sizes(f.read())
+
+def pdf_page_costs(filename: str, page_nums: list[int]) -> dict[int,float]:
+    try:
+        pixels = pdf_image_pixels(filename)
+    except Exception:
+        pixels = {}
+    try:
+        sizes = pdf_content_sizes(filename)
+    except Exception:
+        sizes = {}
+    return { num: PAGE_COST + sizes.get(num, 0) + IMAGE_PIXEL_COST * pixels.get(num, 0) for num in page_nums }
+
+def svg_page_cost(tree: ET.ElementTree) -> float:
+    cost = PAGE_COST
+    for el in tree.iter():
+        cost += SVG_NODE_COST
+        href = el.get('{%s}href' % XLINK_NS, '')
+        if href.startswith('data:'):
+            cost += len(href)
+    return cost
+
+def longest_first(costs: dict[int,float]) -> list[int]:
+    return sorted(costs, key=lambda num: (-costs[num], num))
+
+def simulate(order: list[int], costs: dict[int,float], workers: int) -> list[tuple[int,int,float,float]]:
+    # Each idle worker takes the next page from the shared queue
+    idle = [(0.0, w) for w in range(max(1, workers))]
+    result = []
+    for num in order:
+        start, worker = heapq.heappop(idle)
+        end = start + costs[num]
+        result.append((num, worker, start, end))
+        heapq.heappush(idle, (end, worker))
+    return result
+
+def print_plan(costs: dict[int,float], workers: int) -> None:
+    schedule = simulate(longest_first(costs), costs, workers)
+    print(f'{"page":>6} {"cost":>12} {"worker":>6} {"start":>12} {"end":>12}')
+    for num, worker, start, end in schedule:
+        print(f'{num:>6} {costs[num]:>12.0f} {worker:>6} {start:>12.0f} {end:>12.0f}')
+    makespan = max((end for _, _, _, end in schedule), default=0.0)
+    fifo = simulate(sorted(costs), costs, workers)
+    fifo_makespan = max((end for _, _, _, end in fifo), default=0.0)
+    print(f'estimated makespan: {makespan:.0f} ({workers} workers; page order: {fifo_makespan:.0f})')
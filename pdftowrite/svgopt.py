@@ -0,0 +1,509 @@
+import xml.etree.ElementTree as ET
+import os, re, math, tempfile, threading
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import DEVNULL
+from pathlib import Path
+from typing import Optional
+import pdftowrite.utils as utils
+
+SVG_NS = 'http://www.w3.org/2000/svg'
+XLINK_NS = 'http://www.w3.org/1999/xlink'
+
+PATH_PARAMS = { 'M': 2, 'L': 2, 'H': 1, 'V': 1, 'C': 6, 'S': 4, 'Q': 4, 'T': 2, 'A': 7, 'Z': 0 }
+NUMBER = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+SEPARATOR = re.compile(r'[\s,]*')
+URL_REF = re.compile(r'url\s*\(\s*#\s*(.+?)\s*\)')
+
+# The images of all pages are recompressed by these threads, one single-threaded ImageMagick
+# process each, so the number of processes does not grow with the number of pages in flight
+IMAGE_EXECUTOR = None
+IMAGE_EXECUTOR_LOCK = threading.Lock()
+
+# Elements whose content is rendered in the context of the referencing element
+REF_CONTAINERS = { 'defs', 'symbol', 'clipPath', 'mask', 'pattern', 'marker' }
+
+INHERITED_DEFAULTS = {
+    'fill': '#000000',
+    'fill-opacity': '1',
+    'fill-rule': 'nonzero',
+    'stroke': 'none',
+    'stroke-width': '1',
+    'stroke-linecap': 'butt',
+    'stroke-linejoin': 'miter',
+    'stroke-miterlimit': '4',
+    'stroke-dasharray': 'none',
+    'stroke-dashoffset': '0',
+    'stroke-opacity': '1',
+    'clip-rule': 'nonzero',
+    'visibility': 'visible',
+    'font-style': 'normal',
+    'font-variant': 'normal',
+    'font-weight': 'normal',
+    'font-stretch': 'normal',
+    'writing-mode': 'lr-tb',
+}
+
+NON_INHERITED_DEFAULTS = {
+    'opacity': '1',
+    'mix-blend-mode': 'normal',
+    'display': 'inline',
+}
+
+def parse_path(d: str) -> list[tuple[str,list[float]]]:
+    result = []
+    pos = SEPARATOR.match(d, 0).end()
+    cmd = None
+    while pos < len(d):
+        if d[pos].isalpha():
+            cmd = d[pos]
+            if cmd.upper() not in PATH_PARAMS: raise ValueError(f'Invalid path data: {d}')
+            pos = SEPARATOR.match(d, pos + 1).end()
+            if cmd.upper() == 'Z':
+                result.append((cmd, []))
+                continue
+        elif cmd is None or cmd.upper() == 'Z':
+            raise ValueError(f'Invalid path data: {d}')
+        args = []
+        for i in range(PATH_PARAMS[cmd.upper()]):
+            if cmd.upper() == 'A' and i in (3, 4):
+                # Arc flags may be written without separators (e.g. "a1 1 0 011 1")
+                if pos >= len(d) or d[pos] not in '01':
+                    raise ValueError(f'Invalid path data: {d}')
+                args.append(float(d[pos]))
+                pos += 1
+            else:
+                match = NUMBER.match(d, pos)
+                if not match: raise ValueError(f'Invalid path data: {d}')
+                args.append(float(match.group(0)))
+                pos = match.end()
+            pos = SEPARATOR.match(d, pos).end()
+        result.append((cmd, args))
+        # Coordinate pairs following a moveto are implicit linetos
+        if cmd == 'M': cmd = 'L'
+        elif cmd == 'm': cmd = 'l'
+    return result
+
+def absolutize_path(segments: list[tuple[str,list[float]]]) -> list[tuple[str,list[float]]]:
+    result = []
+    x, y = 0.0, 0.0
+    start_x, start_y = 0.0, 0.0
+    for cmd, args in segments:
+        upper = cmd.upper()
+        rel = cmd != upper
+        if upper == 'Z':
+            result.append(('Z', []))
+            x, y = start_x, start_y
+            continue
+        if upper == 'H':
+            x = args[0] + (x if rel else 0.0)
+            result.append(('H', [x]))
+            continue
+        if upper == 'V':
+            y = args[0] + (y if rel else 0.0)
+            result.append(('V', [y]))
+            continue
+        if upper == 'A':
+            ex, ey = args[5], args[6]
+            if rel: ex, ey = ex + x, ey + y
+            result.append(('A', [*args[:5], ex, ey]))
+            x, y = ex, ey
+            continue
+        abs_args = list(args)
+        if rel:
+            for i in range(0, len(abs_args), 2):
+                abs_args[i] += x
+                abs_args[i+1] += y
+        result.append((upper, abs_args))
+        x, y = abs_args[-2], abs_args[-1]
+        if upper == 'M':
+            start_x, start_y = x, y
+    return result
+
+def format_number(value: float, decimals: int) -> str:
+    text = f'{value:.{decimals}f}'
+    if '.' in text:
+        text = text.rstrip('0').rstrip('.')
+    if text in ('-0', ''):
+        text = '0'
+    if text.startswith('0.'):
+        text = text[1:]
+    elif text.startswith('-0.'):
+        text = '-' + text[2:]
+    return text
+
+def join_numbers(numbers: list[str]) -> str:
+    result = ''
+    for num in numbers:
+        if result and not num.startswith('-'):
+            result += ' '
+        result += num
+    return result
+
+def minify_path(d: str, decimals: int) -> str:
+    segments = absolutize_path( parse_path(d) )
+    rnd = lambda v: round(v, decimals)
+    result = []
+    last_cmd = None
+    x, y = 0.0, 0.0
+    start_x, start_y = 0.0, 0.0
+    for cmd, args in segments:
+        if cmd == 'Z':
+            candidates = [('z', [])]
+            x, y = start_x, start_y
+        elif cmd == 'H':
+            nx = rnd(args[0])
+            candidates = [('H', [nx]), ('h', [rnd(nx - x)])]
+            x = nx
+        elif cmd == 'V':
+            ny = rnd(args[0])
+            candidates = [('V', [ny]), ('v', [rnd(ny - y)])]
+            y = ny
+        elif cmd == 'A':
+            nx, ny = rnd(args[5]), rnd(args[6])
+            arc = [rnd(args[0]), rnd(args[1]), rnd(args[2]), args[3], args[4]]
+            candidates = [('A', [*arc, nx, ny]), ('a', [*arc, rnd(nx - x), rnd(ny - y)])]
+            x, y = nx, ny
+        else:
+            points = [rnd(v) for v in args]
+            rel_points = [rnd(v - (x if i % 2 == 0 else y)) for i, v in enumerate(points)]
+            if cmd == 'L' and rel_points[0] == 0:
+                candidates = [('V', [points[1]]), ('v', [rel_points[1]])]
+            elif cmd == 'L' and rel_points[1] == 0:
+                candidates = [('H', [points[0]]), ('h', [rel_points[0]])]
+            else:
+                candidates = [(cmd, points), (cmd.lower(), rel_points)]
+            x, y = points[-2], points[-1]
+            if cmd == 'M':
+                start_x, start_y = x, y
+        best = None
+        for c, nums in candidates:
+            text = join_numbers([format_number(v, decimals) for v in nums])
+            # A repeated command letter can be omitted, except for movetos and closepaths
+            if c != last_cmd or c in 'MmZz':
+                text = c + text
+            elif not text.startswith('-'):
+                text = ' ' + text
+            if best is None or len(text) < len(best[1]):
+                best = (c, text)
+        result.append(best[1])
+        last_cmd = best[0]
+    return ''.join(result)
+
+class _Minifier:
+    def __init__(self, tree: ET.ElementTree, precision: float):
+        self.root = tree.getroot()
+        self.parent_map = { c:p for p in self.root.iter() for c in p }
+        self.refs = self.__collect_refs()
+        self.scales = {}
+        vb = self.root.get('viewBox')
+        if vb:
+            vals = utils.viewbox_vals(vb)
+            extent = max(utils.val(vals[2]), utils.val(vals[3]))
+        else:
+            extent = max(utils.px(self.root.get('width', '0')), utils.px(self.root.get('height', '0')))
+        self.step = extent * precision if extent > 0 else precision
+
+    def __collect_refs(self) -> dict[str,list[ET.Element]]:
+        refs = {}
+        for el in self.root.iter():
+            href = el.get('{%s}href' % XLINK_NS, el.get('href', ''))
+            if href.strip().startswith('#'):
+                refs.setdefault(href.strip()[1:].strip(), []).append(el)
+            for v in el.attrib.values():
+                for match in URL_REF.finditer(v):
+                    refs.setdefault(match.group(1), []).append(el)
+        return refs
+
+    def own_matrix(self, el: ET.Element) -> tuple[float,...]:
+        matrix = utils.parse_transform(el.get('transform', ''))
+        if utils.tagname(el) == 'svg' and el is not self.root and el.get('viewBox') and el.get('width'):
+            vb_width = utils.val(utils.viewbox_vals(el.get('viewBox'))[2])
+            if vb_width > 0:
+                s = utils.px(el.get('width')) / vb_width
+                matrix = utils.multiply_matrix(matrix, (s, 0.0, 0.0, s, 0.0, 0.0))
+        return matrix
+
+    def scale(self, el: ET.Element, depth: int = 0) -> float:
+        if el in self.scales: return self.scales[el]
+        own = utils.matrix_scale(self.own_matrix(el))
+        parent = self.parent_map.get(el)
+        id = el.get('id')
+        if depth < 32 and id in self.refs and self.__in_ref_container(el):
+            base = max(self.scale(ref, depth+1) for ref in self.refs[id])
+        elif parent is not None:
+            base = self.scale(parent, depth)
+        else:
+            base = 1.0
+        result = base * own
+        self.scales[el] = result
+        return result
+
+    def __in_ref_container(self, el: ET.Element) -> bool:
+        while el is not None:
+            if utils.tagname(el) in REF_CONTAINERS: return True
+            el = self.parent_map.get(el)
+        return False
+
+    def decimals(self, el: ET.Element) -> int:
+        scale = self.scale(el)
+        step = self.step / scale if scale > 0 else self.step
+        return max(0, math.ceil(-math.log10(step)))
+
+    def minify_paths(self) -> None:
+        for el in self.root.iter('{%s}path' % SVG_NS):
+            d = el.get('d')
+            if not d: continue
+            try:
+                el.set('d', minify_path(d, self.decimals(el)))
+            except ValueError:
+                pass
+
+    def strip_attributes(self) -> None:
+        self.__strip(self.root, dict(INHERITED_DEFAULTS), True)
+
+    def __strip(self, el: ET.Element, inherited: dict[str,str], contextual: bool) -> None:
+        tag = utils.tagname(el)
+        # Inherited values of referenced content depend on the referencing site
+        if tag in REF_CONTAINERS or el.get('id') in self.refs:
+            contextual = False
+        computed = dict(inherited)
+
+        decls = parse_style(el.get('style', ''))
+        kept = []
+        for name, value in decls:
+            if self.__is_default(name, value, inherited, contextual): continue
+            kept.append((name, value))
+            if name in INHERITED_DEFAULTS: computed[name] = normalize_value(value)
+        for name in list(el.attrib):
+            if name not in INHERITED_DEFAULTS and name not in NON_INHERITED_DEFAULTS: continue
+            value = el.get(name)
+            if any(n == name for n, _ in decls) or self.__is_default(name, value, inherited, contextual):
+                el.attrib.pop(name)
+            elif name in INHERITED_DEFAULTS and all(n != name for n, _ in kept):
+                computed[name] = normalize_value(value)
+
+        if kept:
+            el.set('style', ';'.join(f'{n}:{v}' for n, v in kept))
+        else:
+            el.attrib.pop('style', None)
+        for name in ('class', 'transform'):
+            if name in el.attrib and not el.get(name).strip():
+                el.attrib.pop(name)
+        if 'transform' in el.attrib:
+            try:
+                if utils.is_identity(utils.parse_transform(el.get('transform'))):
+                    el.attrib.pop('transform')
+            except ValueError:
+                pass
+
+        for child in el:
+            self.__strip(child, computed, contextual)
+
+    def __is_default(self, name: str, value: str, inherited: dict[str,str], contextual: bool) -> bool:
+        value = normalize_value(value)
+        if name in NON_INHERITED_DEFAULTS:
+            return value == NON_INHERITED_DEFAULTS[name]
+        if name in INHERITED_DEFAULTS and contextual:
+            return value == inherited[name]
+        return False
+
+def parse_style(style: str) -> list[tuple[str,str]]:
+    result = []
+    for decl in style.split(';'):
+        name, sep, value = decl.partition(':')
+        name = name.strip()
+        value = value.strip()
+        if not sep or not name or not value: continue
+        result.append((name, value))
+    return result
+
+def normalize_value(value: str) -> str:
+    value = value.strip().lower()
+    if value == 'black':
+        return '#000000'
+    if re.fullmatch(r'#[0-9a-f]{3}', value):
+        return '#' + ''.join(c*2 for c in value[1:])
+    match = re.fullmatch(r'(\d+\.?\d*|\.\d+)(px)?', value)
+    if match:
+        return format_number(float(match.group(1)), 6)
+    return value
+
+def minify(tree: ET.ElementTree, precision: float) -> None:
+    minifier = _Minifier(tree, precision)
+    minifier.minify_paths()
+    minifier.strip_attributes()
+
+def _root_px_scale(root: ET.Element) -> float:
+    vb = root.get('viewBox')
+    if not vb or not root.get('width'): return 1.0
+    vb_width = utils.val(utils.viewbox_vals(vb)[2])
+    return utils.px(root.get('width')) / vb_width if vb_width > 0 else 1.0
+
+def image_executor() -> ThreadPoolExecutor:
+    global IMAGE_EXECUTOR
+    with IMAGE_EXECUTOR_LOCK:
+        if IMAGE_EXECUTOR is None:
+            IMAGE_EXECUTOR = ThreadPoolExecutor(os.cpu_count() or 1, thread_name_prefix='image')
+        return IMAGE_EXECUTOR
+
+def recompress_image(data: bytes, suffix: str, width: int, height: int, quality: int,
+                     limits: Optional[utils.Limits] = None) -> Optional[tuple[str,bytes]]:
+    # Shrinks the image to at most width x height pixels, and picks JPEG for opaque images
+    # with many colors, PNG otherwise. Returns None if it would not get smaller.
+    env = { **os.environ, 'MAGICK_THREAD_LIMIT': '1' }
+    with tempfile.TemporaryDirectory() as tmpdir:
+        src = str(Path(tmpdir) / f'image{suffix}')
+        with open(src, 'wb') as f:
+            f.write(data)
+        info = utils.check_output(['identify', '-format', '%w %h %[opaque] %k\n', src], limits,
+                                  env=env, stderr=DEVNULL)
+        w, h, opaque, colors = info.decode('utf-8').splitlines()[0].split()
+        w, h, colors = int(w), int(h), int(colors)
+        factor = min(1.0, max(width / w, height / h))
+        resize = ['-resize', f'{max(1, round(w*factor))}x{max(1, round(h*factor))}!'] if factor < 1.0 else []
+        if opaque.lower() == 'true' and colors > 256:
+            header, dst, opts = 'data:image/jpeg;base64', str(Path(tmpdir) / 'out.jpeg'), ['-quality', str(quality)]
+        else:
+            header, dst, opts = 'data:image/png;base64', str(Path(tmpdir) / 'out.png'), ['-define', 'png:compression-level=9']
+        utils.check_call(['convert', src, *resize, '-strip', *opts, dst], limits,
+                         env=env, stdout=DEVNULL, stderr=DEVNULL)
+        with open(dst, 'rb') as f:
+            result = f.read()
+    if len(result) >= len(data): return None
+    return header, result
+
+def optimize_images(tree: ET.ElementTree, dpi: int, quality: int,
+                    limits: Optional[utils.Limits] = None) -> tuple[int,int,int]:
+    # Returns (number of images, bytes before, bytes after)
+    minifier = _Minifier(tree, 1.0)
+    px_scale = _root_px_scale(minifier.root)
+    jobs = []
+    for el in minifier.root.iter('{%s}image' % SVG_NS):
+        href = el.get('{%s}href' % XLINK_NS, '').strip()
+        # Only embedded images can be recompressed, not references like "#id" or external files
+        if not href.startswith('data:') or ',' not in href: continue
+        header, suffix, data = utils.decode_image_uri(href)
+        if not header or not el.get('width') or not el.get('height'): continue
+        # Pixels needed to show the image at dpi with its placed size (96 px per inch)
+        scale = minifier.scale(el) * px_scale * dpi / 96
+        width = math.ceil(utils.px(el.get('width')) * scale)
+        height = math.ceil(utils.px(el.get('height')) * scale)
+        if width <= 0 or height <= 0: continue
+        jobs.append((el, data, suffix, width, height))
+    if not jobs: return 0, 0, 0
+
+    before = after = 0
+    results = image_executor().map(lambda job: recompress_image(job[1], job[2], job[3], job[4], quality, limits), jobs)
+    for (el, data, _, _, _), result in zip(jobs, results):
+        before += len(data)
+        if result is None:
+            after += len(data)
+            continue
+        header, data = result
+        after += len(data)
+        el.set('{%s}href' % XLINK_NS, header + ',' + utils.encode_image_uri(data))
+    return len(jobs), before, after
+
+def _xs(el: ET.Element, name: str) -> Optional[list[float]]:
+    value = el.get(name)
+    if value is None: return None
+    return [float(v) for v in NUMBER.findall(value)]
+
+def _same_attribs(el1: ET.Element, el2: ET.Element, ignore: tuple[str,...]) -> bool:
+    a1 = { k: v for k, v in el1.attrib.items() if k not in ignore }
+    a2 = { k: v for k, v in el2.attrib.items() if k not in ignore }
+    return a1 == a2
+
+def _text_offset(text1: ET.Element, text2: ET.Element) -> Optional[tuple[float,float]]:
+    # Offset of text2 in the local coordinates of text1, if their transforms differ only by translation
+    m1 = utils.parse_transform(text1.get('transform', ''))
+    m2 = utils.parse_transform(text2.get('transform', ''))
+    if any(abs(v1 - v2) > 1e-9 for v1, v2 in zip(m1[:4], m2[:4])): return None
+    a, b, c, d, e, f = m1
+    det = a*d - b*c
+    if abs(det) < 1e-12: return None
+    de, df = m2[4] - e, m2[5] - f
+    return (d*de - c*df) / det, (a*df - b*de) / det
+
+def _tspans_mergeable(text: ET.Element) -> bool:
+    if text.text: return False
+    if len(text) == 0: return False
+    for child in text:
+        if utils.tagname(child) != 'tspan' or len(child) > 0 or child.tail: return False
+    first = text[0]
+    return first.get('x') is not None and first.get('y') is not None
+
+def _shift(el: ET.Element, name: str, delta: float) -> None:
+    vals = _xs(el, name)
+    if vals is None or delta == 0: return
+    el.set(name, ' '.join(format_number(v + delta, 4) for v in vals))
+
+def _keep_word_break(last: ET.Element, first: ET.Element) -> None:
+    # Separate text elements are separate words; keep a space placed at the next word
+    if (last.text or ' ')[-1].isspace() or (first.text or ' ')[0].isspace(): return
+    xs = first.get('x').strip().split()
+    first.set('x', ' '.join([xs[0], *xs]))
+    first.text = ' ' + first.text
+
+def _merge_texts(group: ET.Element) -> None:
+    current = None
+    for text in list(group):
+        if utils.tagname(text) != 'text':
+            current = None
+            continue
+        if not _tspans_mergeable(text):
+            current = None
+            continue
+        if current is not None and _same_attribs(current, text, ('transform',)):
+            offset = _text_offset(current, text)
+            # Only runs sharing a baseline are merged
+            same_baseline = current[-1].get('y') == text[0].get('y')
+            if offset is not None and abs(offset[1]) < 1e-4 and same_baseline:
+                tspans = list(text)
+                _keep_word_break(current[-1], tspans[0])
+                for tspan in tspans:
+                    _shift(tspan, 'x', offset[0])
+                    current.append(tspan)
+                group.remove(text)
+                continue
+        current = text
+
+def _merge_tspans(text: ET.Element) -> None:
+    prev = None
+    for tspan in list(text):
+        if prev is not None and tspan.get('x') is not None and _same_attribs(prev, tspan, ('x',)):
+            prev_xs = _xs(prev, 'x')
+            ys = _xs(tspan, 'y')
+            if prev_xs and ys is not None and len(ys) == 1 and len(prev_xs) == len(prev.text or ''):
+                prev.set('x', prev.get('x').strip() + ' ' + tspan.get('x').strip())
+                prev.text = (prev.text or '') + (tspan.text or '')
+                text.remove(tspan)
+                continue
+        prev = tspan
+
+def _classify_styles(group: ET.Element, suffix: str) -> Optional[ET.Element]:
+    counts = {}
+    for el in group.iter():
+        if 'style' not in el.attrib: continue
+        decls = [ (n, v) for n, v in parse_style(el.get('style')) if not n.startswith('-inkscape') ]
+        style = ';'.join(f'{n}:{v}' for n, v in decls)
+        el.set('style', style)
+        counts[style] = counts.get(style, 0) + 1
+    classes = {}
+    for style, count in counts.items():
+        if count > 1: classes[style] = f'tl{len(classes)}{suffix}'
+    if not classes: return None
+    for el in group.iter():
+        cls = classes.get(el.get('style'))
+        if not cls: continue
+        el.attrib.pop('style')
+        el.set('class', (el.get('class', '') + ' ' + cls).strip())
+    style_el = ET.Element('style')
+    style_el.text = ''.join(f'.{cls}{{{style}}}' for style, cls in classes.items())
+    return style_el
+
+def compact_text(group: ET.Element, suffix: str) -> Optional[ET.Element]:
+    _merge_texts(group)
+    for text in group.findall('./{%s}text' % SVG_NS):
+        _merge_tspans(text)
+    return _classify_styles(group, suffix)
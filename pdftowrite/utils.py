@@ -1,8 +1,128 @@
-import subprocess, re, sys, base64, tempfile
+import subprocess, re, sys, os, base64, tempfile, math, resource, signal, threading
+import argparse, contextlib
 from subprocess import DEVNULL
-from typing import Optional, Any
+from typing import Optional, Any, Callable
 from pathlib import Path
+from enum import Enum
 import xml.etree.ElementTree as ET
+import pdftowrite.pgzip as pgzip
+
+class FailurePolicy(Enum):
+    ABORT = 'abort'
+    RASTER = 'raster'
+    SKIP = 'skip'
+
+    def __str__(self):
+        return self.value
+
+class Limits:
+    def __init__(self, timeout: Optional[float] = None, memory: Optional[int] = None, cpu: Optional[int] = None):
+        self.timeout = timeout # seconds of wall-clock time
+        self.memory = memory # MiB of address space
+        self.cpu = cpu # seconds of CPU time
+
+    def apply(self, pid: int) -> None:
+        # Set on the started process, because preexec_fn is not safe with threads
+        if self.memory:
+            size = self.memory * 1024 * 1024
+            resource.prlimit(pid, resource.RLIMIT_AS, (size, size))
+        if self.cpu:
+            resource.prlimit(pid, resource.RLIMIT_CPU, (self.cpu, self.cpu))
+
+LIMITS = Limits()
+# Process groups of running commands, to be killed when we are interrupted
+PROCESS_GROUPS = set()
+PROCESS_GROUPS_LOCK = threading.Lock()
+
+def set_limits(timeout: Optional[float], memory: Optional[int], cpu: Optional[int]) -> Limits:
+    global LIMITS
+    LIMITS = Limits(timeout, memory, cpu)
+    return LIMITS
+
+def kill_process_group(pgid: int) -> None:
+    with contextlib.suppress(ProcessLookupError, PermissionError):
+        os.killpg(pgid, signal.SIGKILL)
+
+def kill_processes() -> None:
+    with PROCESS_GROUPS_LOCK:
+        pgids = list(PROCESS_GROUPS)
+    for pgid in pgids:
+        kill_process_group(pgid)
+
+def run_command(args: list[str], limits: Optional[Limits] = None, **kwargs) -> tuple[int,Any]:
+    # The command runs in its own session, so that a timeout also kills the processes it started
+    # (e.g. the sandboxed Inkscape of "flatpak run")
+    limits = limits or LIMITS
+    with subprocess.Popen(args, start_new_session=True, **kwargs) as proc:
+        with PROCESS_GROUPS_LOCK:
+            PROCESS_GROUPS.add(proc.pid)
+        try:
+            try:
+                limits.apply(proc.pid)
+            except ProcessLookupError:
+                pass # Already exited
+            try:
+                output, _ = proc.communicate(timeout=limits.timeout)
+            except subprocess.TimeoutExpired:
+                kill_process_group(proc.pid)
+                proc.wait()
+                raise
+            except BaseException:
+                kill_process_group(proc.pid)
+                raise
+        finally:
+            with PROCESS_GROUPS_LOCK:
+                PROCESS_GROUPS.discard(proc.pid)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, args, output)
+    return proc.returncode, output
+
+def check_call(args: list[str], limits: Optional[Limits] = None, **kwargs) -> int:
+    return run_command(args, limits, **kwargs)[0]
+
+def check_output(args: list[str], limits: Optional[Limits] = None, **kwargs) -> bytes:
+    return run_command(args, limits, stdout=subprocess.PIPE, **kwargs)[1]
+
+def add_limit_args(parser: argparse.ArgumentParser) -> None:
+    # Options for running pages on workers, limiting them and handling their failures
+    parser.add_argument('--workers', metavar='SPEC', action='store', type=str, default=None,
+                        help='Render pages on remote workers (e.g. "host1:8765,host2:8765", or "local:4" '
+                             'to start 4 local worker processes)')
+    parser.add_argument('--remote-timeout', action='store', type=float, default=600.0,
+                        help='Specify timeout in seconds for each remote page job (default: 600)')
+    parser.add_argument('--timeout', action='store', type=float, default=None,
+                        help='Specify wall-clock timeout in seconds for each external command')
+    parser.add_argument('--memory-limit', action='store', type=int, default=None,
+                        help='Specify address space limit in MiB for each external command')
+    parser.add_argument('--cpu-limit', action='store', type=int, default=None,
+                        help='Specify CPU time limit in seconds for each external command')
+    parser.add_argument('--retries', action='store', type=int, default=0,
+                        help='Specify number of retries for failed pages (default: 0)')
+    parser.add_argument('--on-failure', type=FailurePolicy, default=FailurePolicy.ABORT,
+                        choices=list(FailurePolicy),
+                        help='Specify what to do with failed pages: abort, raster fallback or '
+                             'skip with a placeholder page (default: abort)')
+
+def render_safely(render: Callable[[], Any], fallback: Callable[[FailurePolicy], Any], page_num: int,
+                  retries: int, on_failure: FailurePolicy, failures: list) -> Any:
+    # Retries render, then falls back to a raster page, then to a blank page, as on_failure allows
+    error = None
+    for _ in range(retries + 1):
+        try:
+            return render()
+        except Exception as e:
+            error = e
+    if on_failure is FailurePolicy.ABORT: raise error
+    policies = [FailurePolicy.RASTER, FailurePolicy.SKIP]
+    if on_failure is FailurePolicy.SKIP: policies.remove(FailurePolicy.RASTER)
+    for policy in policies:
+        try:
+            result = fallback(policy)
+            failures.append((page_num, error, policy))
+            return result
+        except Exception as e:
+            error = e
+    raise error
 
 def query_yn(question: str) -> bool:
     while True:
@@ -31,11 +151,11 @@ def flatpak_app_installed(app_id: str) -> bool:
     res = subprocess.check_call(['flatpak', 'info', app_id], stdout=DEVNULL, stderr=DEVNULL)
     return res == 0
 
-def inkscape_run(args: list[str]) -> int:
+def inkscape_run(args: list[str], limits: Optional[Limits] = None) -> int:
     if cmd_exists(['inkscape', '--help']):
-        return subprocess.check_call(['inkscape', *args])
+        return check_call(['inkscape', *args], limits)
     elif flatpak_app_installed('org.inkscape.Inkscape'):
-        return subprocess.check_call(['flatpak', 'run', 'org.inkscape.Inkscape', *args])
+        return check_call(['flatpak', 'run', 'org.inkscape.Inkscape', *args], limits)
     else:
         raise FileNotFoundError('You need to install inkscape (either native or flatpak)')
 
@@ -47,21 +167,59 @@ def pattern_get(pattern: str, string: str, group: int) -> str:
     return g
 
 def number_of_pages(filename: str) -> int:
-    res = subprocess.check_output(['pdfinfo', filename]).decode(sys.stdout.encoding)
+    res = check_output(['pdfinfo', filename]).decode(sys.stdout.encoding)
     match = re.search(r'^\s*Pages:\s*(\d+)', res, flags=re.MULTILINE)
     return int(match.group(1))
 
-def pdf_page_size(filename: str, page: int) -> tuple[str,str]:
+def pdf_page_size(filename: str, page: int, limits: Optional[Limits] = None) -> tuple[str,str]:
     with tempfile.TemporaryDirectory() as tmpdir:
         dest = str(Path(tmpdir) / 'page.pdf')
         cmd = ['pdftk', filename, 'cat', str(page), 'output', dest]
-        subprocess.check_call(cmd, stdout=DEVNULL, stderr=DEVNULL)
-        res = subprocess.check_output(['pdfinfo', dest]).decode(sys.stdout.encoding)
+        check_call(cmd, limits, stdout=DEVNULL, stderr=DEVNULL)
+        res = check_output(['pdfinfo', dest], limits).decode(sys.stdout.encoding)
     match = re.search(r'^\s*Page\s+size:\s*(\d+)\s*x\s*(\d+)', res, flags=re.MULTILINE)
     width = int( match.group(1) )
     height = int( match.group(2) )
     return f'{width}pt', f'{height}pt'
 
+def pdf_page_size_pt(filename: str, page: int, limits: Optional[Limits] = None) -> tuple[float,float]:
+    res = check_output(['pdfinfo', '-f', str(page), '-l', str(page), filename], limits).decode(sys.stdout.encoding)
+    match = re.search(r'^\s*Page\s+\d+\s+size:\s*([0-9.]+)\s*x\s*([0-9.]+)', res, flags=re.MULTILINE)
+    if not match: raise ValueError(f'Page size not found: {filename} #{page}')
+    return float(match.group(1)), float(match.group(2))
+
+def pdf_page_digest(filename: str, page: int) -> str:
+    import pdftowrite.pdfopt as pdfopt
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dest = str(Path(tmpdir) / 'page.pdf')
+        check_call(['pdfseparate', '-f', str(page), '-l', str(page), filename, dest], stdout=DEVNULL, stderr=DEVNULL)
+        with open(dest, 'rb') as f:
+            data = f.read()
+    # pdfseparate keeps the object numbers of the source, which change whenever an object is
+    # added or removed anywhere in it, so the hash is built from the content of the objects
+    return pdfopt.page_digest(data)
+
+def read_svg(filename: str) -> str:
+    ext = Path(filename).suffix
+    if ext == '.svgz':
+        return pgzip.decompress_file(filename).decode('utf-8')
+    elif ext != '.svg':
+        raise ValueError(f'Invalid file extension: {ext} (Use .svg or .svgz)')
+    with open(filename, 'r') as f:
+        return f.read()
+
+def print_failures(failures: list[tuple[int,Exception,FailurePolicy]]) -> None:
+    if not failures: return
+    print(f'{len(failures)} page(s) failed:', file=sys.stderr)
+    for page_num, error, policy in sorted(failures, key=lambda f: f[0]):
+        print(f'  page #{page_num}: {error!r} ({policy})', file=sys.stderr)
+
+def print_peak_memory() -> None:
+    # ru_maxrss is in KiB on Linux; for children it is that of the largest one
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    print(f'peak memory: {self_rss:.0f} MiB (largest external command: {children_rss:.0f} MiB)')
+
 def parse_range(text: str, num_pages: int) -> set[int]:
     tokens: list[str] = text.split()
     if not tokens: return set()
@@ -82,6 +240,14 @@ def parse_range(text: str, num_pages: int) -> set[int]:
         raise ValueError(f'Invalid page range: {text}')
     return pages
 
+def parse_volume_size(text: str) -> tuple[int,int]:
+    # Returns (pages, bytes) per volume, e.g. "100" -> (100, 0), "50MB" -> (0, 50 MiB)
+    match = re.search(r'^\s*(\d+)\s*(MB|M)?\s*$', text, re.I)
+    if not match or int(match.group(1)) <= 0: raise ValueError(f'Invalid volume size: {text}')
+    if match.group(2):
+        return 0, int(match.group(1)) << 20
+    return int(match.group(1)), 0
+
 def find_elements_by_class(tree: ET.ElementTree, cls: str) -> list[ET.Element]:
     result = []
     for el in tree.iter():
@@ -149,3 +315,54 @@ def viewbox_vals(value: str) -> list[str]:
     pattern = rf'{num}\s+{num}\s+{num}\s+{num}'
     match = re.search(pattern, value)
     return [ match.group(1), match.group(2), match.group(3), match.group(4) ]
+
+IDENTITY = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+
+def multiply_matrix(m1: tuple[float,...], m2: tuple[float,...]) -> tuple[float,...]:
+    a1, b1, c1, d1, e1, f1 = m1
+    a2, b2, c2, d2, e2, f2 = m2
+    return (
+        a1*a2 + c1*b2,
+        b1*a2 + d1*b2,
+        a1*c2 + c1*d2,
+        b1*c2 + d1*d2,
+        a1*e2 + c1*f2 + e1,
+        b1*e2 + d1*f2 + f1,
+    )
+
+def parse_transform(value: str) -> tuple[float,...]:
+    result = IDENTITY
+    for match in re.finditer(r'([a-zA-Z]+)\s*\(([^)]*)\)', value):
+        name = match.group(1)
+        args = [float(v) for v in re.findall(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?', match.group(2))]
+        if name == 'matrix' and len(args) == 6:
+            m = tuple(args)
+        elif name == 'translate' and args:
+            m = (1.0, 0.0, 0.0, 1.0, args[0], args[1] if len(args) > 1 else 0.0)
+        elif name == 'scale' and args:
+            m = (args[0], 0.0, 0.0, args[1] if len(args) > 1 else args[0], 0.0, 0.0)
+        elif name == 'rotate' and args:
+            rad = math.radians(args[0])
+            cos, sin = math.cos(rad), math.sin(rad)
+            m = (cos, sin, -sin, cos, 0.0, 0.0)
+            if len(args) == 3:
+                cx, cy = args[1], args[2]
+                m = multiply_matrix((1.0, 0.0, 0.0, 1.0, cx, cy), multiply_matrix(m, (1.0, 0.0, 0.0, 1.0, -cx, -cy)))
+        elif name == 'skewX' and args:
+            m = (1.0, 0.0, math.tan(math.radians(args[0])), 1.0, 0.0, 0.0)
+        elif name == 'skewY' and args:
+            m = (1.0, math.tan(math.radians(args[0])), 0.0, 1.0, 0.0, 0.0)
+        else:
+            raise ValueError(f'Invalid transform: {value}')
+        result = multiply_matrix(result, m)
+    return result
+
+def is_identity(matrix: tuple[float,...]) -> bool:
+    return all(abs(v - i) < 1e-12 for v, i in zip(matrix, IDENTITY))
+
+def matrix_scale(matrix: tuple[float,...]) -> float:
+    # Largest stretch factor (max singular value)
+    a, b, c, d, _, _ = matrix
+    s = a*a + b*b + c*c + d*d
+    det = a*d - b*c
+    return math.sqrt( (s + math.sqrt(max(s*s - 4*det*det, 0.0))) / 2 )
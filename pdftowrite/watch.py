@@ -0,0 +1,97 @@
+import os, select, struct, time, ctypes, ctypes.util
+from pathlib import Path
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct('iIII')
+# Writes that arrive within this many seconds of each other are handled as one save
+SETTLE_TIME = 0.2
+POLL_INTERVAL = 0.5
+
+class FileWatcher:
+    # Waits for the files to be saved. Editors that save by renaming a temporary file
+    # over the original are handled, because the directories are watched rather than the files.
+    def __init__(self, filenames: list[str]):
+        self.paths = { str(Path(f).resolve()): f for f in filenames }
+        self.fd = -1
+        try:
+            self.__init_inotify()
+        except (OSError, AttributeError):
+            self.fd = -1
+        self.stats = { path: self.__stat(path) for path in self.paths }
+
+    def __init_inotify(self) -> None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(IN_CLOEXEC)
+        if fd < 0: raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.dirs = {}
+        for path in self.paths:
+            dir = str(Path(path).parent)
+            if dir in self.dirs.values(): continue
+            wd = libc.inotify_add_watch(fd, dir.encode(), IN_CLOSE_WRITE | IN_MOVED_TO)
+            if wd < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), f'inotify_add_watch failed: {dir}')
+            self.dirs[wd] = dir
+        self.fd = fd
+
+    @property
+    def method(self) -> str:
+        return 'inotify' if self.fd >= 0 else 'polling'
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def __stat(self, path: str):
+        try:
+            st = os.stat(path)
+            return st.st_mtime_ns, st.st_size
+        except FileNotFoundError:
+            return None
+
+    def __read_events(self, timeout) -> set[str]:
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready: return set()
+        data = os.read(self.fd, 65536)
+        result = set()
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, pos)
+            # Names need not be valid UTF-8, and are decoded like those of os.listdir()
+            name = os.fsdecode( data[pos+EVENT_HEADER.size:pos+EVENT_HEADER.size+length].rstrip(b'\0') )
+            pos += EVENT_HEADER.size + length
+            path = os.path.join(self.dirs.get(wd, ''), name)
+            if path in self.paths: result.add(self.paths[path])
+        return result
+
+    def __poll(self) -> set[str]:
+        result = set()
+        for path, filename in self.paths.items():
+            stat = self.__stat(path)
+            if stat != self.stats[path]:
+                self.stats[path] = stat
+                if stat is not None: result.add(filename)
+        return result
+
+    def wait(self) -> set[str]:
+        # Returns the saved files
+        if self.fd >= 0:
+            changed = set()
+            while not changed:
+                changed = self.__read_events(None)
+            while True:
+                more = self.__read_events(SETTLE_TIME)
+                if not more: return changed
+                changed |= more
+        changed = set()
+        while not changed:
+            time.sleep(POLL_INTERVAL)
+            changed = self.__poll()
+        while True:
+            time.sleep(SETTLE_TIME)
+            more = self.__poll()
+            if not more: return changed
+            changed |= more
@@ -1,16 +1,20 @@
-import argparse, tempfile, shutil, subprocess, asyncio, sys, os
+import argparse, re, tempfile, subprocess, asyncio, sys, os, copy, shutil, time, hashlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Awaitable
 from pathlib import Path
 import pdftowrite.utils as utils
+import pdftowrite.schedule as schedule
 import pdftowrite.docs
-from pdftowrite.docs import SVG_NS, Page, Document
+from pdftowrite.docs import SVG_NS, XLINK_NS, Page, Document
 from pdftowrite import __version__
 
 WK_SCALE = 1.333333333
+MERGE_FANOUT = 32
 
 def arg_parser():
     parser = argparse.ArgumentParser(description='Convert Stylus Labs Write document to PDF')
-    parser.add_argument('file', metavar='FILE', type=str, nargs=1,
-                        help='A Write document')
+    parser.add_argument('file', metavar='FILE', type=str, nargs='+',
+                        help='A Write document, or all volumes of one in order')
     parser.add_argument('-v', '--version', action='version', version=__version__)
     parser.add_argument('--annot', action='store_true',
                         help='Use annotation mode')
@@ -24,21 +28,17 @@ def arg_parser():
                         help='Specify pages to convert (e.g. "1 2 3", "1-3") (default: all)')
     parser.add_argument('-s', '--scale', action='store', type=float, default=1.0,
                         help='Scale page size (default: 1.0)')
+    parser.add_argument('-O', '--optimize', action='store_true',
+                        help='Deduplicate identical fonts, images and other objects across pages')
+    parser.add_argument('--split-every', metavar='N', action='store', type=int, default=0,
+                        help='Split output into volumes of N pages (e.g. example-001.pdf)')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep running, and update the output each time FILE is saved')
+    parser.add_argument('--plan', action='store_true',
+                        help='Print the estimated page schedule and exit')
+    utils.add_limit_args(parser)
     return parser
 
-def read_svg(filename: str) -> str:
-    with tempfile.TemporaryDirectory() as tmpdir:
-        ext = Path(filename).suffix
-        if ext == '.svgz':
-            new_filename = str(Path(tmpdir) / Path(filename).name)
-            shutil.copy(filename, new_filename)
-            subprocess.check_call(['gzip', '-S', 'z', '-df', new_filename])
-            filename = str(Path(new_filename).with_suffix('.svg'))
-        elif ext != '.svg':
-            raise ValueError(f'Invalid file extension: {ext} (Use .svg or .svgz)')
-        with open(filename, 'r') as f:
-            return f.read()
-
 def get_pdf_file(page: Page, ns: argparse.Namespace) -> str:
     if ns.pdf_file:
         if not Path(ns.pdf_file).exists():
@@ -58,14 +58,35 @@ def get_pdf_pagenum(page: Page) -> int:
     else:
         return page.page_num
 
-def process_page(page: Page, output_dir: str, ns: argparse.Namespace) -> str:
+def render_fallback(filename: str, width: str, height: str, output: str, output_dir: str,
+                    policy: utils.FailurePolicy, limits: Optional[utils.Limits] = None) -> None:
+    image = ''
+    if policy is utils.FailurePolicy.RASTER:
+        png = str(Path(output_dir) / f'{Path(filename).stem}-raster.png')
+        utils.check_call(['rsvg-convert', '-f', 'png', '-z', '2', '-o', png, filename], limits,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        with open(png, 'rb') as f:
+            encoded = utils.encode_image_uri(f.read())
+        os.remove(png)
+        image = (f'<image width="{utils.val(width)}" height="{utils.val(height)}" preserveAspectRatio="none" '
+                 f'xlink:href="data:image/png;base64,{encoded}" />')
+    fallback = str(Path(output_dir) / f'{Path(filename).stem}-fallback.svg')
+    with open(fallback, 'w') as f:
+        f.write(f'<svg xmlns="{SVG_NS}" xmlns:xlink="{XLINK_NS}" width="{width}" height="{height}" '
+                f'viewBox="0 0 {utils.val(width)} {utils.val(height)}">{image}</svg>')
+    utils.check_call(['rsvg-convert', '-f', 'pdf', '-o', output, fallback], limits,
+                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    os.remove(fallback)
+
+def process_page(page: Page, output_dir: str, ns: argparse.Namespace,
+                 fallback: Optional[utils.FailurePolicy] = None) -> str:
     if utils.unit(page.width) == '%' or utils.unit(page.height) == '%':
         raise Exception(f'Percentage(%) is not supported for page size')
 
     if ns.annot:
         pdf_file = get_pdf_file(page, ns)
         pdf_page_num = get_pdf_pagenum(page)
-        width, height = utils.pdf_page_size(pdf_file, pdf_page_num)
+        width, height = utils.pdf_page_size(pdf_file, pdf_page_num, ns.limits)
         scale = 1.0
         page.remove_ruleline()
     else:
@@ -82,7 +103,7 @@ def process_page(page: Page, output_dir: str, ns: argparse.Namespace) -> str:
     width = page.width
     height = page.height
 
-    if not ns.annot:
+    if not ns.annot and not fallback:
         page.width = f'{utils.val(width) * WK_SCALE}{utils.unit(width)}'
         page.height = f'{utils.val(height) * WK_SCALE}{utils.unit(height)}'
 
@@ -101,70 +122,287 @@ def process_page(page: Page, output_dir: str, ns: argparse.Namespace) -> str:
     with open(filename, 'w') as f:
         f.write(page.svg)
 
-    if ns.annot:
-        subprocess.check_call(['rsvg-convert',
+    if fallback:
+        render_fallback(filename, width, height, page_output, output_dir, fallback, ns.limits)
+    elif ns.annot:
+        utils.check_call(['rsvg-convert',
                 '-f', 'pdf',
                 '-o', page_output,
                 filename
-            ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            ], ns.limits, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
     else:
-        subprocess.check_call(['wkhtmltopdf',
+        utils.check_call(['wkhtmltopdf',
                 '--page-width', f'{width}', '--page-height', f'{height}',
                 '-T', '0', '-R', '0', '-B', '0', '-L', '0',
                 '--no-background',
                 filename, output
-            ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            ], ns.limits, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
         if utils.cmd_exists(['pdftk', '--help']):
-            subprocess.check_call(['pdftk', output, 'cat', '1', 'output', page_output])
+            utils.check_call(['pdftk', output, 'cat', '1', 'output', page_output], ns.limits)
         else:
             page_output_pattern = str(Path(output_dir) / f'page-{page.page_num}-%d.pdf')
-            subprocess.check_call(['pdfseparate', '-f', '1', '-l', '1', output, page_output_pattern])
+            utils.check_call(['pdfseparate', '-f', '1', '-l', '1', output, page_output_pattern], ns.limits)
         os.remove(output)
     os.remove(filename)
 
     if ns.annot:
         pdf_page_output = str(Path(output_dir) / f'page-{page.page_num}-pdf.pdf')
-        subprocess.check_call(['pdftk', pdf_file, 'cat', str(pdf_page_num), 'output', pdf_page_output])
+        utils.check_call(['pdftk', pdf_file, 'cat', str(pdf_page_num), 'output', pdf_page_output], ns.limits)
 
         annot_output = str(Path(output_dir) / f'page-{page.page_num}-annot.pdf')
-        subprocess.check_call(['pdftk', pdf_page_output, 'stamp', page_output, 'output', annot_output])
+        utils.check_call(['pdftk', pdf_page_output, 'stamp', page_output, 'output', annot_output], ns.limits)
         os.remove(page_output)
         os.remove(pdf_page_output)
         return annot_output
     else:
         return page_output
 
-async def generate_pdf(doc: Document, output: str, ns: argparse.Namespace) -> None:
-    with tempfile.TemporaryDirectory() as tmpdir:
+def process_page_safely(page: Page, output_dir: str, ns: argparse.Namespace, failures: list,
+                        pool: Optional['remote.WorkerPool'] = None) -> str:
+    # process_page modifies the page, so every attempt works on a fresh copy
+    def render() -> str:
+        if pool:
+            pdf_file = get_pdf_file(page, ns) if ns.annot else None
+            return pool.render_page(copy.deepcopy(page), output_dir, ns, pdf_file)
+        return process_page(copy.deepcopy(page), output_dir, ns)
+    fallback = lambda policy: process_page(copy.deepcopy(page), output_dir, ns, policy)
+    return utils.render_safely(render, fallback, page.page_num, ns.retries, ns.on_failure, failures)
+
+def merge_pdfs(inputs: list[str], output: str, use_pdftk: bool) -> None:
+    if len(inputs) == 1:
+        shutil.copy(inputs[0], output)
+    elif use_pdftk:
+        utils.check_call(['pdftk', *inputs, 'cat', 'output', output])
+    else:
+        utils.check_call(['pdfunite', *inputs, output])
+
+class Merger:
+    def __init__(self, output_dir: str, executor: ThreadPoolExecutor, use_pdftk: bool, keep_inputs: bool = False):
+        self.output_dir = output_dir
+        self.executor = executor
+        self.use_pdftk = use_pdftk
+        self.keep_inputs = keep_inputs # Do not delete the page PDFs (e.g. cached ones)
+        self.count = 0
+
+    async def merge(self, parts: list[Awaitable[str]], output: str) -> str:
+        # Merges groups of parts as soon as they are ready, then the merged groups, and so on
+        nodes = parts
+        remove = not self.keep_inputs
+        while len(nodes) > MERGE_FANOUT:
+            groups = [nodes[i:i+MERGE_FANOUT] for i in range(0, len(nodes), MERGE_FANOUT)]
+            nodes = [asyncio.ensure_future(self.__merge_node(group, self.__tmp_output(), remove)) for group in groups]
+            remove = True
+        return await self.__merge_node(nodes, output, remove)
+
+    def __tmp_output(self) -> str:
+        self.count += 1
+        return str(Path(self.output_dir) / f'merge-{self.count}.pdf')
+
+    async def __merge_node(self, children: list[Awaitable[str]], output: str, remove: bool) -> str:
+        inputs = await asyncio.gather(*children)
         loop = asyncio.get_running_loop()
-        tasks = []
-        for page in doc.pages:
-            task = loop.run_in_executor(None, process_page, page, tmpdir, ns)
-            tasks.append(task)
-        pages = await asyncio.gather(*tasks)
-        if utils.cmd_exists(['pdftk', '--help']):
-            subprocess.check_call(['pdftk', *pages, 'cat', 'output', output])
-        else:
-            subprocess.check_call(['pdfunite', *pages, output])
+        await loop.run_in_executor(self.executor, merge_pdfs, inputs, output, self.use_pdftk)
+        if remove:
+            for input in inputs:
+                os.remove(input)
+        return output
+
+def print_optimize_stats(output: str, stats: Optional[tuple[int,int,int]]) -> None:
+    if not stats:
+        print(f'{output}: nothing to deduplicate')
+        return
+    before, after, merged = stats
+    ratio = (1 - after / before) * 100 if before else 0.0
+    print(f'{output}: {before} -> {after} bytes (-{ratio:.1f}%), {merged} objects merged')
+
+async def finish_volume(merged: Awaitable[str], executor: ThreadPoolExecutor, ns: argparse.Namespace) -> None:
+    output = await merged
+    if ns.optimize:
+        import pdftowrite.pdfopt as pdfopt
+        loop = asyncio.get_running_loop()
+        print_optimize_stats(output, await loop.run_in_executor(executor, pdfopt.optimize_file, output))
+
+def volume_outputs(output: str, num_pages: int, ns: argparse.Namespace) -> list[str]:
+    if ns.split_every <= 0 or num_pages <= ns.split_every:
+        return [output]
+    num_volumes = (num_pages + ns.split_every - 1) // ns.split_every
+    path = Path(output)
+    return [str(path.with_name(f'{path.stem}-{i:03d}{path.suffix}')) for i in range(1, num_volumes + 1)]
+
+async def generate_pdf(doc: Document, output: str, ns: argparse.Namespace, failures: list,
+                       pool: Optional['remote.WorkerPool'] = None) -> None:
+    with tempfile.TemporaryDirectory() as tmpdir, ThreadPoolExecutor(max(1, (os.cpu_count() or 1) // 2)) as executor:
+        loop = asyncio.get_running_loop()
+        # The most expensive pages are dispatched first, but merged in page order
+        pages = { page.page_num: page for page in doc.pages }
+        costs = { num: schedule.svg_page_cost(page.tree) for num, page in pages.items() }
+        futures = {}
+        for num in schedule.longest_first(costs):
+            futures[num] = loop.run_in_executor(None, process_page_safely, pages[num], tmpdir, ns, failures, pool)
+        tasks = [futures[page.page_num] for page in doc.pages]
+        merger = Merger(tmpdir, executor, utils.cmd_exists(['pdftk', '--help']))
+        outputs = volume_outputs(output, len(tasks), ns)
+        size = ns.split_every if len(outputs) > 1 else len(tasks)
+        volumes = []
+        for i, volume_output in enumerate(outputs):
+            volumes.append( finish_volume(merger.merge(tasks[i*size:(i+1)*size], volume_output), executor, ns) )
+        await asyncio.gather(*volumes)
+
+class PageCache:
+    # Page PDFs by page number and content, kept between exports in watch mode
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self.files = {}
+
+    def render(self, page: Page, digest: str, ns: argparse.Namespace, failures: list,
+               pool: Optional['remote.WorkerPool'] = None) -> str:
+        output = process_page_safely(page, self.cache_dir, ns, failures, pool)
+        cached = str(Path(self.cache_dir) / f'cache-{page.page_num}-{digest[:16]}.pdf')
+        os.replace(output, cached)
+        # Failed pages are rendered again on the next save
+        if all(f[0] != page.page_num for f in failures):
+            self.files[(page.page_num, digest)] = cached
+        return cached
+
+    def retain(self, keys: set[tuple[int,str]]) -> None:
+        self.files = { key: file for key, file in self.files.items() if key in keys }
+        kept = set(self.files.values())
+        for path in Path(self.cache_dir).glob('cache-*.pdf'):
+            if str(path) not in kept: os.remove(path)
+
+async def export_pages(pages: dict[int,Page], digests: dict[int,str], output: str, ns: argparse.Namespace,
+                       failures: list, cache: PageCache, executor: ThreadPoolExecutor, merger: Merger,
+                       pool: Optional['remote.WorkerPool'] = None) -> int:
+    # Renders only the pages that are not cached, and replaces the outputs atomically.
+    # Returns the number of rendered pages.
+    loop = asyncio.get_running_loop()
+    stale = [num for num in pages if (num, digests[num]) not in cache.files]
+    costs = { num: schedule.svg_page_cost(pages[num].tree) for num in stale }
+    futures = {}
+    for num in schedule.longest_first(costs):
+        futures[num] = loop.run_in_executor(executor, cache.render, pages[num], digests[num], ns, failures, pool)
+    tasks = [futures[num] if num in futures else asyncio.sleep(0, cache.files[(num, digests[num])])
+             for num in sorted(pages)]
+
+    async def export_volume(parts: list[Awaitable[str]], output: str) -> None:
+        tmp_output = await merger.merge(parts, output + '.tmp')
+        if ns.optimize:
+            import pdftowrite.pdfopt as pdfopt
+            await loop.run_in_executor(merger.executor, pdfopt.optimize_file, tmp_output)
+        os.replace(tmp_output, output)
+
+    outputs = volume_outputs(output, len(tasks), ns)
+    size = ns.split_every if len(outputs) > 1 else len(tasks)
+    await asyncio.gather(*[export_volume(tasks[i*size:(i+1)*size], volume_output)
+                           for i, volume_output in enumerate(outputs)])
+    cache.retain({ (num, digests[num]) for num in pages })
+    return len(stale)
+
+def watch_document(output: str, ns: argparse.Namespace, loop: asyncio.AbstractEventLoop,
+                   pool: Optional['remote.WorkerPool'] = None) -> None:
+    import pdftowrite.watch as watch
+    watcher = watch.FileWatcher(ns.file)
+    print(f'watching {", ".join(ns.file)} ({watcher.method}), press Ctrl+C to stop', flush=True)
+    # Parsed pages of each file as (number within the file, page, digest of its content)
+    volumes = {}
+    changed = set(ns.file)
+    saved, event = time.time(), 'start'
+    with tempfile.TemporaryDirectory() as cache_dir, \
+         ThreadPoolExecutor(schedule.default_workers()) as executor, \
+         ThreadPoolExecutor(max(1, (os.cpu_count() or 1) // 2)) as merge_executor:
+        cache = PageCache(cache_dir)
+        merger = Merger(cache_dir, merge_executor, utils.cmd_exists(['pdftk', '--help']), keep_inputs=True)
+        try:
+            while True:
+                try:
+                    # Only the saved files are read and parsed again
+                    for filename in changed:
+                        svg = utils.read_svg(filename)
+                        count = pdftowrite.docs.num_pages(svg)
+                        doc = Document(svg, set(range(1, count + 1)))
+                        volumes[filename] = (count, [(page.page_num, page, hashlib.sha256(page.svg.encode('utf-8')).hexdigest())
+                                                     for page in doc.pages])
+                    page_nums = utils.parse_range(ns.pages, sum(count for count, _ in volumes.values()))
+                    pages, digests = {}, {}
+                    offset = 0
+                    for filename in ns.file:
+                        count, entries = volumes[filename]
+                        for num, page, digest in entries:
+                            if offset + num not in page_nums: continue
+                            page.page_num = offset + num
+                            pages[page.page_num] = page
+                            digests[page.page_num] = digest
+                        offset += count
+                    failures = []
+                    rendered = loop.run_until_complete(
+                        export_pages(pages, digests, output, ns, failures, cache, executor, merger, pool) )
+                    print(f'{output}: {rendered} of {len(pages)} page(s) rendered, '
+                          f'updated {time.time() - saved:.2f}s after {event}', flush=True)
+                    utils.print_failures(failures)
+                except Exception as e:
+                    print(f'{output}: not updated: {e}', file=sys.stderr, flush=True)
+                changed = watcher.wait()
+                event = 'save'
+                try:
+                    saved = max(os.stat(filename).st_mtime for filename in changed)
+                except OSError:
+                    saved = time.time()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
 
 def run(args):
     parser = arg_parser()
     ns = parser.parse_args(args)
     filename = ns.file[0]
 
-    svg = read_svg(filename)
-    num_pages = pdftowrite.docs.num_pages(svg)
+    # Volumes are numbered as one document
+    svgs = [utils.read_svg(f) for f in ns.file]
+    counts = [pdftowrite.docs.num_pages(svg) for svg in svgs]
+    num_pages = sum(counts)
     if num_pages <= 0: raise Exception('Document has no pages')
     page_nums = utils.parse_range(ns.pages, num_pages)
-    doc = Document(svg, page_nums)
-    output = ns.output if ns.output else str(Path(filename).with_suffix('.pdf'))
+    doc = Document(svgs[0], page_nums)
+    for i in range(1, len(svgs)):
+        doc.pages += Document(svgs[i], page_nums, sum(counts[:i])).pages
+    svgs = None
+    if ns.output:
+        output = ns.output
+    elif len(ns.file) > 1:
+        path = Path(filename)
+        output = str(path.with_name(re.sub(r'-\d{3}$', '', path.stem) + '.pdf'))
+    else:
+        output = str(Path(filename).with_suffix('.pdf'))
+
+    if ns.plan:
+        costs = { page.page_num: schedule.svg_page_cost(page.tree) for page in doc.pages }
+        schedule.print_plan(costs, schedule.default_workers())
+        return
 
-    if not ns.force and Path(output).exists():
-        if not utils.query_yn(f'Overwrite?: {output}'): return
+    for volume_output in volume_outputs(output, len(doc.pages), ns):
+        if not ns.force and Path(volume_output).exists():
+            if not utils.query_yn(f'Overwrite?: {volume_output}'): return
 
+    ns.limits = utils.set_limits(ns.timeout, ns.memory_limit, ns.cpu_limit)
+    failures = []
+    pool = None
+    if ns.workers:
+        # Only remote rendering needs the HTTP modules
+        import pdftowrite.remote as remote
+        pool = remote.WorkerPool.from_spec(ns.workers, timeout=ns.remote_timeout)
     loop = asyncio.get_event_loop()
-    loop.run_until_complete( generate_pdf(doc, output, ns) )
+    try:
+        if ns.watch:
+            watch_document(output, ns, loop, pool)
+        else:
+            loop.run_until_complete( generate_pdf(doc, output, ns, failures, pool) )
+    finally:
+        # Commands run in their own sessions, so they do not get the interrupt themselves
+        utils.kill_processes()
+        if pool: pool.close()
     loop.close()
+    utils.print_failures(failures)
 
 def main():
     run(sys.argv[1:])
@@ -45,6 +45,7 @@ setuptools.setup(
         'console_scripts': [
             'pdftowrite=pdftowrite.pdftowrite:main',
             'writetopdf=pdftowrite.writetopdf:main',
+            'pdftowrite-worker=pdftowrite.remote:main',
         ],
     },
 )
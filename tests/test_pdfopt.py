@@ -0,0 +1,207 @@
+import re, zlib
+import pdftowrite.pdfopt as pdfopt
+
+def build_pdf(objects: dict[int,bytes], root: int = 1) -> bytes:
+    out = bytearray(b'%PDF-1.4\n')
+    offsets = {}
+    for num, body in objects.items():
+        offsets[num] = len(out)
+        out += b'%d 0 obj\n' % num + body + b'\nendobj\n'
+    size = max(objects) + 1
+    xref = len(out)
+    out += b'xref\n0 %d\n0000000000 65535 f\r\n' % size
+    for num in range(1, size):
+        out += b'%010d 00000 n\r\n' % offsets[num] if num in offsets else b'0000000000 00001 f\r\n'
+    out += b'trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (size, root, xref)
+    return bytes(out)
+
+def stream(data: bytes) -> bytes:
+    return b'<< /Length %d >>\nstream\n' % len(data) + data + b'\nendstream'
+
+def xref_entries(data: bytes) -> list[tuple[int,int,bytes]]:
+    table = re.search(rb'xref\n0 (\d+)\n(.*?)trailer', data, re.S)
+    entries = [tuple(line.split()) for line in table.group(2).splitlines()]
+    assert len(entries) == int(table.group(1))
+    return [(int(offset), int(gen), kind) for offset, gen, kind in entries]
+
+def document(pages: list[bytes], extra: dict[int,bytes] = {}) -> dict[int,bytes]:
+    kids = b' '.join(b'%d 0 R' % (3 + i) for i in range(len(pages)))
+    objects = {
+        1: b'<< /Type /Catalog /Pages 2 0 R >>',
+        2: b'<< /Type /Pages /Kids [%s] /Count %d >>' % (kids, len(pages)),
+    }
+    for i, page in enumerate(pages):
+        objects[3 + i] = b'<< /Type /Page /Parent 2 0 R ' + page + b' >>'
+    objects.update(extra)
+    return objects
+
+def test_duplicate_streams_are_merged():
+    data = build_pdf(document([b'/Contents 5 0 R', b'/Contents 6 0 R'], {
+        5: stream(b'0 0 m 10 10 l S'),
+        6: stream(b'0 0 m 10 10 l S'),
+    }))
+    result, merged = pdfopt.optimize(data)
+    assert merged == 1
+    _, objects = pdfopt.parse_objects(result)
+    assert (6, 0) not in objects
+    assert objects[(4, 0)].head.strip() == b'<< /Type /Page /Parent 2 0 R /Contents 5 0 R >>'
+
+def test_merging_makes_referencing_objects_identical():
+    # 7 and 8 only differ by the duplicates they refer to
+    data = build_pdf(document([b'/Resources 7 0 R', b'/Resources 8 0 R'], {
+        5: stream(b'image'),
+        6: stream(b'image'),
+        7: b'<< /XObject << /Im0 5 0 R >> >>',
+        8: b'<< /XObject << /Im0 6 0 R >> >>',
+    }))
+    result, merged = pdfopt.optimize(data)
+    assert merged == 2
+    _, objects = pdfopt.parse_objects(result)
+    assert set(objects) == {(1, 0), (2, 0), (3, 0), (4, 0), (5, 0), (7, 0)}
+    assert b'/Resources 7 0 R' in objects[(4, 0)].head
+
+def test_pages_are_never_merged():
+    data = build_pdf(document([b'/Contents 5 0 R', b'/Contents 5 0 R'], { 5: stream(b'q Q') }))
+    assert pdfopt.optimize(data) is None
+
+def test_strings_and_comments_are_kept():
+    # "R" and "endobj" inside strings and comments must neither end the object nor be rewritten
+    tricky = (b'<< /Title (6 0 R endobj \\) 6 0 R) /Alt <36203020 52> % 6 0 R endobj stream\n'
+              b'/Ref 6 0 R >>')
+    data = build_pdf(document([b'/Contents 5 0 R /Extra 7 0 R'], {
+        5: stream(b'(endobj) Tj'),
+        6: stream(b'(endobj) Tj'),
+        7: tricky,
+    }))
+    header, objects = pdfopt.parse_objects(data)
+    assert header == b'%PDF-1.4\n'
+    assert objects[(7, 0)].head.strip() == tricky
+    assert objects[(5, 0)].stream == objects[(6, 0)].stream
+    result, merged = pdfopt.optimize(data)
+    assert merged == 1
+    _, objects = pdfopt.parse_objects(result)
+    assert objects[(7, 0)].head.strip() == tricky.replace(b'/Ref 6 0 R', b'/Ref 5 0 R')
+
+def test_rewrite_refs():
+    resolve = lambda ref: (1, 0) if ref == (2, 0) else ref
+    assert pdfopt.rewrite_refs(b'[2 0 R 12 0 R (2 0 R)]', resolve) == b'[1 0 R 12 0 R (2 0 R)]'
+    assert pdfopt.rewrite_refs(b'/A 2 0 R%2 0 R\n/B 2 0 R', resolve) == b'/A 1 0 R%2 0 R\n/B 1 0 R'
+    assert pdfopt.rewrite_refs(b'/Name2 0 R', resolve) == b'/Name2 0 R'
+
+def test_xref_offsets_and_free_list():
+    data = build_pdf(document([b'/Contents 5 0 R /A 7 0 R /B 9 0 R'], {
+        5: stream(b'q Q'),
+        6: stream(b'q Q'),
+        7: stream(b'BT ET'),
+        8: stream(b'BT ET'),
+        9: b'<< /Free 1 >>',
+        11: b'<< /Unused true >>',
+    }))
+    result, merged = pdfopt.optimize(data)
+    assert merged == 2
+    entries = xref_entries(result)
+    assert len(entries) == 12
+    free = [num for num, (_, _, kind) in enumerate(entries) if kind == b'f']
+    # Object 0 heads the list of the merged and missing objects, which ends at 0
+    assert free == [0, 4, 6, 8, 10]
+    assert [entries[num][0] for num in free] == [4, 6, 8, 10, 0]
+    assert entries[0][1] == 65535
+    assert entries[4][1] == entries[6][1] == entries[8][1] == 1
+    for num, (offset, gen, kind) in enumerate(entries):
+        if kind == b'n':
+            assert result[offset:].startswith(b'%d %d obj' % (num, gen))
+    startxref = int(re.search(rb'startxref\n(\d+)', result).group(1))
+    assert result[startxref:].startswith(b'xref\n')
+
+def test_trailer_size_and_incremental_updates():
+    data = build_pdf(document([b'/Contents 5 0 R /A 6 0 R'], {
+        5: stream(b'old'),
+        6: stream(b'new'),
+    }))
+    # An incremental update that makes 5 and 6 identical and adds a trailer with /Prev
+    update = b'5 0 obj\n' + stream(b'new') + b'\nendobj\n'
+    offset = len(data)
+    data += update + b'xref\n0 1\n0000000000 65535 f\r\n5 1\n%010d 00000 n\r\n' % offset
+    data += b'trailer\n<< /Size 7 /Root 1 0 R /Prev 123 >>\nstartxref\n%d\n%%%%EOF\n' % (offset + len(update))
+    result, merged = pdfopt.optimize(data)
+    assert merged == 1
+    trailer = re.search(rb'trailer\n(<<.*?>>)', result, re.S).group(1)
+    assert b'/Size 7' in trailer
+    assert b'/Prev' not in trailer
+    assert b'/Root 1 0 R' in trailer
+
+def test_unsupported_files_are_left_alone():
+    data = build_pdf(document([b''], { 4: b'<< /Type /XRef >>' }))
+    assert pdfopt.optimize(data) is None
+    assert pdfopt.optimize(b'not a pdf') is None
+
+def single_page(shift: int, content: bytes = b'0 0 m 10 10 l S', extra: dict[int,bytes] = {}) -> bytes:
+    # The same page with its objects numbered from shift, as pdfseparate writes pages of revised files
+    n = lambda i: i + shift
+    objects = {
+        n(4): stream(content),
+        n(5): b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+        n(6): b'<< /Type /Annot /Subtype /Text /P %d 0 R /Contents (note 1 0 R) >>' % n(3),
+        n(3): b'<< /Type /Page /Parent %d 0 R /Contents %d 0 R /Annots [%d 0 R] >>' % (n(2), n(4), n(6)),
+        n(2): b'<< /Type /Pages /Kids [%d 0 R] /Count 1 /MediaBox [0 0 612 792] '
+              b'/Resources << /Font << /F1 %d 0 R >> >> >>' % (n(3), n(5)),
+        n(1): b'<< /Type /Catalog /Pages %d 0 R >>' % n(2),
+        **extra,
+    }
+    data = build_pdf(dict(sorted(objects.items())), root=n(1))
+    return data
+
+def test_page_digest_does_not_depend_on_numbering():
+    digest = pdfopt.page_digest(single_page(0))
+    assert pdfopt.page_digest(single_page(40)) == digest
+    assert pdfopt.page_digest(single_page(7, extra={ 1: b'<< /Unrelated true >>' })) == digest
+
+def test_page_digest_changes_with_content():
+    digest = pdfopt.page_digest(single_page(0))
+    assert pdfopt.page_digest(single_page(0, content=b'0 0 m 10 20 l S')) != digest
+    # Inherited resources are part of the page
+    changed = single_page(0).replace(b'/BaseFont /Helvetica', b'/BaseFont /Courier  ')
+    assert pdfopt.page_digest(changed) != digest
+
+def test_page_digest_with_object_streams():
+    page = b'<< /Type /Page /Parent 2 0 R /Contents 4 0 R >>'
+    pages = b'<< /Type /Pages /Kids [3 0 R] /Count 1 /MediaBox [0 0 612 792] >>'
+    catalog = b'<< /Type /Catalog /Pages 2 0 R >>'
+    body = catalog + b'\n' + pages + b'\n' + page
+    index = b'1 0 2 %d 3 %d ' % (len(catalog) + 1, len(catalog) + len(pages) + 2)
+    compressed = zlib.compress(index + body)
+    objstm = (b'<< /Type /ObjStm /N 3 /First %d /Filter /FlateDecode /Length %d >>\nstream\n'
+              % (len(index), len(compressed)) + compressed + b'\nendstream')
+    data = build_pdf({ 4: stream(b'0 0 m 10 10 l S'), 5: objstm })
+    plain = build_pdf({ 1: catalog, 2: pages, 3: page, 4: stream(b'0 0 m 10 10 l S') })
+    assert pdfopt.page_digest(data) == pdfopt.page_digest(plain)
+
+def test_page_digest_ignores_linked_pages():
+    def two_pages(other: bytes) -> bytes:
+        return build_pdf(document([b'/Contents 5 0 R /Annots [7 0 R]', b'/Contents 6 0 R'], {
+            5: stream(b'0 0 m 10 10 l S'),
+            6: stream(other),
+            7: b'<< /Type /Annot /Subtype /Link /Rect [0 0 10 10] /Dest [4 0 R /Fit] >>',
+        }))
+    assert pdfopt.page_digest(two_pages(b'BT ET')) == pdfopt.page_digest(two_pages(b'q Q'))
+
+def test_page_content_sizes():
+    form = b'<< /Type /XObject /Subtype /Form /BBox [0 0 1 1] /Length 400 >>\nstream\n' + b'0' * 400 + b'\nendstream'
+    image = b'<< /Type /XObject /Subtype /Image /Width 1 /Height 1 /Length 900 >>\nstream\n' + b'0' * 900 + b'\nendstream'
+    data = build_pdf({
+        1: b'<< /Type /Catalog /Pages 2 0 R >>',
+        # Resources inherited by all pages
+        2: b'<< /Type /Pages /Kids [3 0 R 4 0 R 5 0 R] /Count 3 /Resources << /XObject << /Fm0 8 0 R >> >> >>',
+        3: b'<< /Type /Page /Parent 2 0 R /Contents [6 0 R 7 0 R] /Resources << /XObject << /Im0 9 0 R >> >> >>',
+        4: b'<< /Type /Page /Parent 2 0 R /Contents 7 0 R /Annots [10 0 R] >>',
+        5: b'<< /Type /Page /Parent 2 0 R >>',
+        6: stream(b'0' * 100),
+        7: stream(b'0' * 200),
+        8: form,
+        9: image,
+        10: b'<< /Type /Annot /Subtype /Link /P 4 0 R /Dest [3 0 R /Fit] >>',
+    })
+    content = lambda num: len(pdfopt.parse_objects(data)[1][(num, 0)].stream)
+    sizes = pdfopt.page_content_sizes(data)
+    # The inherited form is drawn on every page, the image and the linked page are not counted
+    assert sizes == { 1: content(6) + content(7) + content(8), 2: content(7) + content(8), 3: content(8) }
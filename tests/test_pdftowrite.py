@@ -0,0 +1,72 @@
+import pytest
+from pdftowrite.docs import Document
+from pdftowrite.pdftowrite import plan_update
+
+def write_page(pdf_page, pdf_hash, note=None) -> str:
+    attribs = f' data-pdf-file="in.pdf" data-pdf-page="{pdf_page}" data-pdf-hash="{pdf_hash}"' if pdf_page else ''
+    annotation = f'<path class="note" d="M0 0L1 1" id="{note}" />' if note else ''
+    return (f'<svg class="write-page" x="10" y="10" width="816px" height="1056px">'
+            f'<g class="write-content write-v3"><g class="ruleline"{attribs}>'
+            f'<rect class="pagerect" width="816px" height="1056px" /></g>{annotation}</g></svg>')
+
+def document(*pages) -> Document:
+    body = ''.join(write_page(*page) for page in pages)
+    svg = f'<svg xmlns="http://www.w3.org/2000/svg" id="write-document">{body}</svg>'
+    return Document(svg, set(range(1, len(pages) + 1)))
+
+def summary(entries) -> list[tuple]:
+    # (PDF page, existing page or None, converted), with the followers after their entry
+    result = []
+    for entry in entries:
+        for e in [entry, *entry.followers]:
+            result.append((e.page_num, e.existing.page_num if e.existing else None, e.convert))
+    return result
+
+def test_unchanged():
+    existing = document((1, 'a', 'n1'), (2, 'b'), (3, 'c'))
+    entries = plan_update(existing, [1, 2, 3], { 1: 'a', 2: 'b', 3: 'c' })
+    assert summary(entries) == [(1, 1, False), (2, 2, False), (3, 3, False)]
+
+def test_changed_page_takes_annotations_of_old_version():
+    existing = document((1, 'a'), (2, 'b', 'n2'), (3, 'c'))
+    entries = plan_update(existing, [1, 2, 3], { 1: 'a', 2: 'B', 3: 'c' })
+    assert summary(entries) == [(1, 1, False), (2, 2, True), (3, 3, False)]
+    assert [el.get('id') for el in entries[1].existing.annotations] == ['n2']
+
+def test_moved_pages():
+    # A new first page shifts the others, which are matched by their hashes
+    existing = document((1, 'a', 'n1'), (2, 'b', 'n2'))
+    entries = plan_update(existing, [1, 2, 3], { 1: 'new', 2: 'a', 3: 'b' })
+    assert summary(entries) == [(1, None, True), (2, 1, False), (3, 2, False)]
+
+def test_swapped_pages():
+    existing = document((1, 'a', 'n1'), (2, 'b', 'n2'))
+    entries = plan_update(existing, [1, 2], { 1: 'b', 2: 'a' })
+    assert summary(entries) == [(1, 2, False), (2, 1, False)]
+
+def test_duplicate_hashes_prefer_the_same_page_number():
+    existing = document((1, 'blank', 'n1'), (2, 'x'), (3, 'blank', 'n3'))
+    entries = plan_update(existing, [1, 2, 3], { 1: 'blank', 2: 'x', 3: 'blank' })
+    assert summary(entries) == [(1, 1, False), (2, 2, False), (3, 3, False)]
+
+def test_removed_pages():
+    # Removed pages are dropped unless annotated, in which case they stay after the preceding page
+    existing = document((1, 'a'), (2, 'b', 'n2'), (3, 'c'), (4, 'd'))
+    entries = plan_update(existing, [1, 2], { 1: 'a', 2: 'd' })
+    assert summary(entries) == [(1, 1, False), (None, 2, False), (2, 4, False)]
+
+def test_removed_first_page_stays_first():
+    existing = document((1, 'a', 'n1'), (2, 'b'))
+    entries = plan_update(existing, [1], { 1: 'b' })
+    assert summary(entries) == [(None, 1, False), (1, 2, False)]
+
+def test_pages_without_pdf_page_are_kept_in_place():
+    existing = document((1, 'a'), (None, None, 'blank'), (2, 'b'))
+    entries = plan_update(existing, [1, 2], { 1: 'a', 2: 'b' })
+    assert summary(entries) == [(1, 1, False), (None, 2, False), (2, 3, False)]
+
+@pytest.mark.parametrize('hashes', [{ 1: None, 2: 'b' }, { 1: 'A', 2: 'b' }])
+def test_pages_without_matching_hash_are_converted(hashes):
+    existing = document((1, 'a', 'n1'), (2, 'b'))
+    entries = plan_update(existing, [1, 2], hashes)
+    assert summary(entries) == [(1, 1, True), (2, 2, False)]
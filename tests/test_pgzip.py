@@ -0,0 +1,68 @@
+import gzip, io, os, random, threading, zlib
+import pytest
+import pdftowrite.pgzip as pgzip
+
+def sample(size: int) -> bytes:
+    # Compressible but not trivial, so matches cross block boundaries
+    rnd = random.Random(size)
+    words = [bytes(rnd.choices(b'abcdefgh<>/="0123456789 ', k=rnd.randint(1, 12))) for _ in range(200)]
+    data = bytearray()
+    while len(data) < size:
+        data += rnd.choice(words)
+    return bytes(data[:size])
+
+def compress(data: bytes, chunk: int, threads: int = 4) -> bytes:
+    out = io.BytesIO()
+    with pgzip.ParallelGzipWriter(out, level=6, threads=threads) as f:
+        for i in range(0, len(data), chunk):
+            f.write(data[i:i+chunk])
+    return out.getvalue()
+
+@pytest.mark.parametrize('size', [0, 1, 4095, 4096, 4097, 3 * 4096, 3 * 4096 + 17, 40000])
+@pytest.mark.parametrize('chunk', [1000, 4096, 1 << 20])
+def test_round_trip_at_block_boundaries(monkeypatch, size, chunk):
+    monkeypatch.setattr(pgzip, 'BLOCK_SIZE', 4096)
+    data = sample(size)
+    assert gzip.decompress(compress(data, chunk)) == data
+
+def test_round_trip_default_block_size():
+    data = sample(2 * pgzip.BLOCK_SIZE + 1)
+    assert gzip.decompress(compress(data, 300000)) == data
+
+def test_str_is_written_as_utf8(monkeypatch):
+    monkeypatch.setattr(pgzip, 'BLOCK_SIZE', 16)
+    out = io.BytesIO()
+    with pgzip.ParallelGzipWriter(out, threads=2) as f:
+        f.write('ページ' * 10)
+    assert gzip.decompress(out.getvalue()).decode('utf-8') == 'ページ' * 10
+
+def test_decompress_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(pgzip, 'READ_SIZE', 1000)
+    data = sample(50000)
+    filename = tmp_path / 'a.svgz'
+    # Concatenated members, as written by other tools
+    filename.write_bytes(compress(data, 7000) + gzip.compress(data))
+    assert pgzip.decompress_file(str(filename)) == data + data
+
+def test_decompress_truncated_file(tmp_path):
+    filename = tmp_path / 'a.svgz'
+    filename.write_bytes(gzip.compress(sample(50000))[:-100])
+    with pytest.raises(EOFError):
+        pgzip.decompress_file(str(filename))
+
+@pytest.mark.parametrize('corrupt', [
+    lambda data: data[:10] + b'\xff' * 1000 + data[1010:],
+    lambda data: data[:len(data) // 2] + b'\xff' * 1000 + data[len(data) // 2 + 1000:],
+])
+def test_decompress_corrupt_file_stops_reader(tmp_path, monkeypatch, corrupt):
+    # The error stops the reader even when it is waiting for room in the queue
+    monkeypatch.setattr(pgzip, 'READ_SIZE', 64)
+    filename = tmp_path / 'a.svgz'
+    filename.write_bytes(corrupt(gzip.compress(sample(200000))))
+    threads = threading.active_count()
+    fds = len(os.listdir('/proc/self/fd'))
+    for _ in range(5):
+        with pytest.raises(zlib.error):
+            pgzip.decompress_file(str(filename))
+    assert threading.active_count() == threads
+    assert len(os.listdir('/proc/self/fd')) == fds
@@ -0,0 +1,143 @@
+import argparse, base64, http.client, os, socket, threading, urllib.error
+from urllib.parse import urlsplit
+import pytest
+import pdftowrite.remote as remote
+import pdftowrite.writetopdf as w2p
+
+PAGE = ('<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" class="write-page" '
+        'width="816px" height="1056px"><g class="write-content write-v3"><g class="ruleline">'
+        '<rect class="pagerect" width="816px" height="1056px" /></g>{}</g></svg>')
+
+def job(options: dict, body: str = '', pdf: bytes = None) -> dict:
+    return { 'page_num': 1, 'options': options, 'svg': PAGE.format(body),
+             'pdf': base64.b64encode(pdf).decode('ascii') if pdf else None }
+
+def dead_url() -> str:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return f'http://127.0.0.1:{s.getsockname()[1]}'
+
+@pytest.fixture(scope='module')
+def pool():
+    with remote.WorkerPool.from_spec('local:2', retries=1, timeout=30) as pool:
+        yield pool
+
+@pytest.fixture
+def server(monkeypatch):
+    # An in-process worker whose renderer records the options of each job
+    jobs = []
+    def process_page(page, output_dir, ns, fallback=None):
+        jobs.append(ns)
+        output = os.path.join(output_dir, 'page-1.pdf')
+        with open(output, 'wb') as f:
+            f.write(b'%PDF ' + (open(ns.pdf_file, 'rb').read() if ns.annot else b''))
+        return output
+    monkeypatch.setattr(w2p, 'process_page', process_page)
+    server = remote.create_server('127.0.0.1', 0, 2, 'secret')
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield remote.Worker('http://127.0.0.1:%d' % server.server_address[1], 'secret'), jobs
+    server.shutdown()
+    server.server_close()
+
+def test_local_workers(pool):
+    assert len({ w.url for w in pool.workers }) == 2
+    assert all(urlsplit(w.url).hostname == '127.0.0.1' for w in pool.workers)
+    assert all(w.token and w.heartbeat() for w in pool.workers)
+
+def test_token_is_required(pool):
+    for token in ['', 'wrong']:
+        worker = remote.Worker(pool.workers[0].url, token)
+        assert not worker.heartbeat()
+        with pytest.raises(urllib.error.HTTPError) as e:
+            worker.post('/writetopdf', job({}), 10)
+        assert e.value.code == 403
+
+def test_missing_content_length(pool):
+    worker = pool.workers[0]
+    url = urlsplit(worker.url)
+    conn = http.client.HTTPConnection(url.hostname, url.port, timeout=10)
+    try:
+        conn.putrequest('POST', '/writetopdf')
+        conn.putheader(remote.TOKEN_HEADER, worker.token)
+        conn.endheaders()
+        assert conn.getresponse().status == 411
+    finally:
+        conn.close()
+
+@pytest.mark.parametrize('options,body,pdf,message', [
+    ({ 'scale': '2' }, '', None, 'Invalid option: scale'),
+    ({ 'annot': 1 }, '', None, 'Invalid option: annot'),
+    ({ 'annot': True, 'pdf_file': '/etc/hostname' }, '', None, 'Annotation jobs need the PDF page'),
+    ({}, '<image xlink:href="file:///etc/passwd" />', None, 'External reference: file:///etc/passwd'),
+    ({}, '<script>alert(1)</script>', None, 'Scripts are not allowed'),
+])
+def test_invalid_jobs_are_refused(pool, options, body, pdf, message):
+    with pytest.raises(remote.RemoteError, match=message):
+        pool.request('/writetopdf', job(options, body, pdf))
+
+def test_failover_to_alive_worker(pool):
+    worker = pool.workers[0]
+    failover = remote.WorkerPool([dead_url(), worker.url], retries=1, timeout=10, token=worker.token)
+    try:
+        # The job fails on the alive worker too, but only after reaching it
+        with pytest.raises(remote.RemoteError, match='Invalid option'):
+            failover.request('/writetopdf', job({ 'scale': '2' }))
+        assert [w.alive for w in failover.workers] == [False, True]
+    finally:
+        failover.close()
+
+def test_no_alive_workers():
+    pool = remote.WorkerPool([dead_url(), dead_url()], retries=3, timeout=10, token='secret')
+    try:
+        with pytest.raises(remote.RemoteError, match='No alive workers'):
+            pool.request('/writetopdf', job({}))
+    finally:
+        pool.close()
+
+def test_only_allowed_options_are_used(server):
+    worker, jobs = server
+    options = { 'scale': 2, 'timeout': 30, 'memory_limit': None, 'pdf_file': '/etc/hostname', 'optimize': True }
+    assert worker.post('/writetopdf', job(options), 10) == b'%PDF '
+    ns = jobs[-1]
+    assert ns.scale == 2.0 and isinstance(ns.scale, float)
+    assert ns.pdf_file is None and ns.optimize is False
+    assert (ns.limits.timeout, ns.limits.memory) == (30.0, None)
+
+def test_annotation_jobs_use_the_sent_pdf(server):
+    worker, jobs = server
+    options = { 'annot': True, 'pdf_file': '/etc/hostname' }
+    assert worker.post('/writetopdf', job(options, pdf=b'page'), 10) == b'%PDF page'
+    assert jobs[-1].pdf_file != '/etc/hostname'
+
+def test_decode_options():
+    defaults = lambda: argparse.Namespace(dpi=96, precision=0.0001, optimize=False, timeout=None, pdf_file=None)
+    allowed = { 'dpi': int, 'precision': float, 'optimize': bool, 'timeout': float }
+    ns = remote.decode_options({ 'dpi': 300, 'precision': 1, 'timeout': None, 'pdf_file': 'x', 'other': 1 },
+                               allowed, defaults())
+    assert vars(ns) == { 'dpi': 300, 'precision': 1.0, 'optimize': False, 'timeout': None, 'pdf_file': None }
+    for options in [{ 'dpi': True }, { 'dpi': 1.5 }, { 'optimize': 1 }, { 'dpi': None }, { 'precision': '1' }]:
+        with pytest.raises(ValueError):
+            remote.decode_options(options, allowed, defaults())
+
+@pytest.mark.parametrize('body', [
+    '<rect fill="url(#grad)" />',
+    '<use xlink:href="#shape" />',
+    '<image xlink:href="data:image/png;base64,AAAA" />',
+    '<style>.a { fill: url(#grad) }</style>',
+])
+def test_local_refs_are_allowed(body):
+    remote.check_local_refs(PAGE.format(body))
+
+@pytest.mark.parametrize('body', [
+    '<image xlink:href="/etc/passwd" />',
+    '<image href="https://example.com/a.png" />',
+    '<rect style="fill: url( \'file:///x\' )" />',
+    '<rect fill="url(other.svg#grad)" />',
+    '<style>@import url(a.css);</style>',
+    '<style>.a { background: url(file:///x) }</style>',
+    '<foreignObject><iframe xmlns="http://www.w3.org/1999/xhtml" src="file:///etc/passwd" /></foreignObject>',
+    '<script>1</script>',
+])
+def test_external_refs_are_refused(body):
+    with pytest.raises(ValueError):
+        remote.check_local_refs(PAGE.format(body))
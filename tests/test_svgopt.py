@@ -0,0 +1,182 @@
+import pytest
+import xml.etree.ElementTree as ET
+import pdftowrite.svgopt as svgopt
+
+def endpoints(d: str) -> list[tuple[float,float]]:
+    # The current point after each segment
+    result = []
+    x = y = start_x = start_y = 0.0
+    for cmd, args in svgopt.absolutize_path(svgopt.parse_path(d)):
+        if cmd == 'Z': x, y = start_x, start_y
+        elif cmd == 'H': x = args[0]
+        elif cmd == 'V': y = args[0]
+        else: x, y = args[-2], args[-1]
+        if cmd == 'M': start_x, start_y = x, y
+        result.append((x, y))
+    return result
+
+PATHS = [
+    'M10 10 L20 20 L30 5 Z',
+    # Coordinates after a moveto are implicit linetos
+    'm10 10 20 20 30 5z',
+    'M0,0 10,0 10,10',
+    # A relative command after a closepath starts from the start of the subpath
+    'm5 5 l10 0 l0 10 z l-3 -3 z m2 2 l1 1 z h4 v4',
+    'M1.23456 5.67891 c1 1 2 2 3 3 s1 1 2 2 q1 1 2 2 t1 1 h3.33333 v-4.44444 H0 V0 Z',
+    # Arc flags without separators
+    'M0 0 a5 5 0 1015 5 a5 5 30 01-5-5 A2 2 0 1 1 7 7',
+    'M0 0 a1 1 0 011 1 1 1 0 11.5.5',
+    'M-1e-3 2E2 L.5.5 -.5-.5',
+]
+
+@pytest.mark.parametrize('d', PATHS)
+@pytest.mark.parametrize('decimals', [0, 2, 4])
+def test_minify_path_keeps_endpoints(d, decimals):
+    original = endpoints(d)
+    minified = endpoints(svgopt.minify_path(d, decimals))
+    assert len(minified) == len(original)
+    # Endpoints are rounded, but the errors of relative commands do not add up
+    for (x0, y0), (x1, y1) in zip(original, minified):
+        assert abs(x0 - x1) <= 0.5 * 10 ** -decimals + 1e-9
+        assert abs(y0 - y1) <= 0.5 * 10 ** -decimals + 1e-9
+
+def test_parse_path_implicit_lineto():
+    assert svgopt.parse_path('m1 2 3 4 5 6') == [('m', [1, 2]), ('l', [3, 4]), ('l', [5, 6])]
+    assert svgopt.parse_path('M1 2 3 4') == [('M', [1, 2]), ('L', [3, 4])]
+
+def test_parse_path_packed_arc_flags():
+    assert svgopt.parse_path('a1 1 0 011 1') == [('a', [1, 1, 0, 0, 1, 1, 1])]
+    assert svgopt.parse_path('a1 1 0 1,0 2 2') == [('a', [1, 1, 0, 1, 0, 2, 2])]
+
+def test_closepath_resets_current_point():
+    assert endpoints('m5 5 l10 0 z l1 1') == [(5, 5), (15, 5), (5, 5), (6, 6)]
+    assert svgopt.absolutize_path(svgopt.parse_path('m5 5 l10 0 z m1 1')) == [
+        ('M', [5, 5]), ('L', [15, 5]), ('Z', []), ('M', [6, 6])]
+
+@pytest.mark.parametrize('d', ['M0 0 L', '1 1', 'M0 0 a1 1 0 2 0 1 1', 'M0 0 z 1 1', 'M0 0 x1', 'M0 0 e1'])
+def test_parse_path_invalid(d):
+    with pytest.raises(ValueError):
+        svgopt.parse_path(d)
+
+def test_minify_path_output():
+    assert svgopt.minify_path('M 10.000 20.000 L 30.000 20.000 L 30.000 40.000 Z', 3) == 'M10 20H30V40z'
+    assert svgopt.minify_path('M0 0 L0.5 0.25', 3) == 'M0 0L.5 .25'
+    assert svgopt.minify_path('M100 100 L100.5 100.25 L100 100', 3) == 'M100 100l.5 .25-.5-.25'
+
+SVG = ('<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" '
+       'width="100" height="100" viewBox="0 0 100 100">{}</svg>')
+
+def strip(body: str) -> dict[str,dict[str,str]]:
+    # Returns the attributes of the elements with an id after stripping
+    tree = ET.ElementTree(ET.fromstring(SVG.format(body)))
+    svgopt._Minifier(tree, 0.0001).strip_attributes()
+    return { el.get('id'): { k: v for k, v in el.attrib.items() if k != 'id' } for el in tree.iter() if el.get('id') }
+
+def test_strip_inherited_defaults():
+    els = strip('<path id="a" d="M0 0" fill="#000" stroke="none" stroke-width="1px" />'
+                '<path id="b" d="M0 0" fill="red" stroke-linecap="round" />'
+                '<g id="g" fill="red" stroke-width="2"><path id="c" d="M0 0" fill="red" stroke-width="2.0" />'
+                '<path id="d" d="M0 0" fill="black" stroke-width="1" /></g>')
+    assert els['a'] == { 'd': 'M0 0' }
+    assert els['b'] == { 'd': 'M0 0', 'fill': 'red', 'stroke-linecap': 'round' }
+    # Defaults only apply where the parent has not changed the inherited value
+    assert els['c'] == { 'd': 'M0 0' }
+    assert els['d'] == { 'd': 'M0 0', 'fill': 'black', 'stroke-width': '1' }
+
+def test_strip_non_inherited_defaults():
+    els = strip('<g id="g" opacity="1" style="display:inline;mix-blend-mode:normal"><path id="a" d="M0 0" opacity=".5" />'
+                '</g><defs><path id="b" d="M0 0" opacity="1" /></defs><use xlink:href="#b" />')
+    assert els['g'] == {}
+    assert els['a'] == { 'd': 'M0 0', 'opacity': '.5' }
+    # Non-inherited defaults do not depend on where the content is used
+    assert els['b'] == { 'd': 'M0 0' }
+
+def test_strip_keeps_inherited_values_of_referenced_content():
+    els = strip('<defs><path id="a" d="M0 0" fill="#000000" /><clipPath id="clip"><rect id="r" fill="#000" /></clipPath>'
+                '</defs><g id="b" stroke="none"><path id="c" d="M0 0" fill="#000" /></g>'
+                '<use xlink:href="#a" fill="red" /><use xlink:href="#b" stroke="blue" /><path d="M0 0" clip-path="url(#clip)" />')
+    assert els['a'] == { 'd': 'M0 0', 'fill': '#000000' }
+    assert els['r'] == { 'fill': '#000' }
+    assert els['b'] == { 'stroke': 'none' }
+    assert els['c'] == { 'd': 'M0 0', 'fill': '#000' }
+
+def test_strip_style_overrides_presentation_attributes():
+    els = strip('<path id="a" d="M0 0" fill="red" style="fill:blue" />'
+                '<path id="b" d="M0 0" fill="red" style="fill:#000;stroke:none" />'
+                '<g id="g" fill="blue" style="fill:red"><path id="c" d="M0 0" fill="red" /><path id="d" d="M0 0" fill="blue" /></g>')
+    assert els['a'] == { 'd': 'M0 0', 'style': 'fill:blue' }
+    # The style sets the default, so the attribute it overrides goes too
+    assert els['b'] == { 'd': 'M0 0' }
+    assert els['g'] == { 'style': 'fill:red' }
+    assert els['c'] == { 'd': 'M0 0' }
+    assert els['d'] == { 'd': 'M0 0', 'fill': 'blue' }
+
+def test_strip_empty_and_identity_attributes():
+    els = strip('<g id="g" class=" " transform="matrix(1 0 0 1 0 0)"><path id="a" d="M0 0" transform="translate(1)" /></g>')
+    assert els['g'] == {}
+    assert els['a'] == { 'd': 'M0 0', 'transform': 'translate(1)' }
+
+def text_group(*texts: str) -> ET.Element:
+    return ET.fromstring(f'<g xmlns="http://www.w3.org/2000/svg">{"".join(texts)}</g>')
+
+def text(transform: str, x: str, chars: str, y: str = '0', style: str = 'font-size:10px') -> str:
+    return f'<text transform="{transform}" style="{style}"><tspan x="{x}" y="{y}">{chars}</tspan></text>'
+
+def char_positions(group: ET.Element) -> list[tuple[str,float,float]]:
+    # The page position of each character, as placed by the x list of its tspan
+    result = []
+    for t in group.findall('{%s}text' % svgopt.SVG_NS):
+        a, b, c, d, e, f = svgopt.utils.parse_transform(t.get('transform', ''))
+        for tspan in t:
+            xs = [float(v) for v in tspan.get('x').split()]
+            y = float(tspan.get('y'))
+            for char, x in zip(tspan.text, xs):
+                if not char.isspace():
+                    result.append((char, round(a*x + c*y + e, 6), round(b*x + d*y + f, 6)))
+    return result
+
+def test_compact_text_merges_runs_on_a_baseline():
+    group = text_group(text('matrix(2 0 0 2 10 20)', '0 5', 'ab'),
+                       text('matrix(2 0 0 2 40 20)', '0 5', 'cd'),
+                       text('matrix(2 0 0 2 70 20)', '0', 'e'))
+    positions = char_positions(group)
+    svgopt.compact_text(group, '-s')
+    texts = group.findall('{%s}text' % svgopt.SVG_NS)
+    assert len(texts) == 1 and len(texts[0]) == 1
+    # A space separates the words, at the position of the next word
+    assert texts[0][0].text == 'ab cd e'
+    assert texts[0][0].get('x') == '0 5 15 15 20 30 30'
+    assert char_positions(group) == positions
+
+@pytest.mark.parametrize('second', [
+    # Another baseline
+    text('matrix(1 0 0 1 40 30)', '0', 'b'),
+    text('matrix(1 0 0 1 40 20)', '0', 'b', y='3'),
+    # Rotated or scaled differently
+    text('matrix(0 1 -1 0 40 20)', '0', 'b'),
+    text('matrix(2 0 0 2 40 20)', '0', 'b'),
+    # Another style
+    text('matrix(1 0 0 1 40 20)', '0', 'b', style='font-size:12px'),
+])
+def test_compact_text_keeps_separate_runs(second):
+    group = text_group(text('matrix(1 0 0 1 10 20)', '0', 'a'), second)
+    positions = char_positions(group)
+    svgopt.compact_text(group, '-s')
+    assert len(group.findall('{%s}text' % svgopt.SVG_NS)) == 2
+    assert char_positions(group) == positions
+
+def test_compact_text_turns_styles_into_classes():
+    style = 'font-size:10px;-inkscape-font-specification:Sans;fill-opacity:0'
+    group = text_group(text('translate(0 0)', '0', 'a', style=style),
+                       text('translate(0 50)', '0', 'b', style=style),
+                       text('translate(0 90)', '0', 'c', style='font-size:12px'))
+    style_el = svgopt.compact_text(group, '-s')
+    assert style_el.text == '.tl0-s{font-size:10px;fill-opacity:0}'
+    texts = group.findall('{%s}text' % svgopt.SVG_NS)
+    assert [t.get('class') for t in texts] == ['tl0-s', 'tl0-s', None]
+    assert [t.get('style') for t in texts] == [None, None, 'font-size:12px']
+
+def test_compact_text_without_shared_styles():
+    group = text_group(text('translate(0 0)', '0', 'a', style='font-size:10px'))
+    assert svgopt.compact_text(group, '-s') is None
+    assert group[0].get('style') == 'font-size:10px'